@@ -1539,7 +1539,7 @@ async def async_archiver_logic():
 
                                 if batch:
                                     log(f"   ⬆️ {len(batch)} new message(s)")
-                                    supabase_utils.insert_discord_messages(batch)
+                                    supabase_utils.insert_discord_messages(batch, channels=cm.get_enabled_channels())
                                     last_ids[channel_url] = current_ids[-200:]
                                     with open(last_ids_path, 'w') as f: json.dump(last_ids, f)
                                 
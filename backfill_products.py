@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+backfill_products.py
+One-off job: materialize 'products' rows for discord_messages that were
+ingested before the products table existed.
+Usage: python backfill_products.py [hours_back]
+"""
+
+import sys
+import requests
+from datetime import datetime, timedelta
+import supabase_utils
+
+
+def backfill(hours_back: int = 72, page_size: int = 200):
+    url, key = supabase_utils.get_supabase_config()
+    headers = {'apikey': key, 'Authorization': f'Bearer {key}'}
+    since = (datetime.utcnow() - timedelta(hours=hours_back)).isoformat()
+    channels = supabase_utils.load_local_channels()
+
+    print(f"🚀 Backfilling products since {since}...")
+    offset = 0
+    total = 0
+    while True:
+        params = {
+            "select": supabase_utils.message_select("extract"),
+            "scraped_at": f"gte.{since}",
+            "order": "scraped_at.asc,id.asc",
+            "offset": offset,
+            "limit": page_size
+        }
+        res = requests.get(f"{url}/rest/v1/discord_messages", headers=headers, params=params, timeout=60)
+        if res.status_code != 200:
+            print(f"❌ Fetch failed: HTTP {res.status_code} {res.text[:200]}")
+            break
+        messages = supabase_utils.reshape_messages(res.json(), "extract")
+        if not messages:
+            break
+        total += supabase_utils.materialize_products(messages, channels, debug=False)
+        offset += len(messages)
+        print(f"   📦 Scanned {offset} messages, {total} products written")
+        if len(messages) < page_size:
+            break
+
+    print(f"✅ Backfill complete: {total} products")
+
+
+if __name__ == "__main__":
+    backfill(int(sys.argv[1]) if len(sys.argv) > 1 else 72)
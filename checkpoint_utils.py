@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+checkpoint_utils.py
+Write-behind checkpointing for JSON state files (used by the Telegram bot's cursor).
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointManager:
+    """
+    Write-behind persistence for a JSON state file. Saves only mark the state
+    dirty; flush() snapshots it on the loop, then writes atomically (temp file +
+    os.replace) and runs `upload(local_path) -> bool` in `executor`, at most once
+    per interval. A failed write or upload leaves the state dirty for the next
+    flush. flush_now() is the blocking variant for shutdown.
+    """
+    def __init__(self, local_path: str, snapshot: Callable[[], Dict], upload: Callable[[str], bool], interval: float, executor=None):
+        self.local_path = local_path
+        self.snapshot = snapshot
+        self.upload = upload
+        self.interval = interval
+        self.executor = executor
+        self.dirty = False
+        self.last_flush = float("-inf")  # first flush is never held back by the interval
+        self.seq = 0          # bumped per snapshot so an older write never lands after a newer one
+        self.written_seq = 0
+        self.lock = threading.Lock()
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def _take(self) -> Tuple[int, Dict]:
+        self.dirty = False
+        self.seq += 1
+        return self.seq, self.snapshot()
+
+    def _write(self, seq: int, state: Dict) -> bool:
+        with self.lock:
+            if seq <= self.written_seq: return True
+            try:
+                tmp_path = f"{self.local_path}.tmp"
+                with open(tmp_path, 'w') as f: json.dump(state, f)
+                os.replace(tmp_path, self.local_path)
+                if not self.upload(self.local_path):
+                    raise RuntimeError("upload failed")
+                self.written_seq = seq
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ Checkpoint flush failed for {self.local_path}: {e}")
+                self.dirty = True  # retried on the next flush
+                return False
+
+    async def flush(self, force: bool = False) -> Optional[bool]:
+        """Flush if dirty and the interval has passed (or forced); None when nothing was attempted"""
+        if not self.dirty: return None
+        if not force and time.monotonic() - self.last_flush < self.interval: return None
+        self.last_flush = time.monotonic()
+        seq, state = self._take()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._write, seq, state)
+
+    def flush_now(self) -> Optional[bool]:
+        if not self.dirty: return None
+        return self._write(*self._take())
@@ -7,21 +7,29 @@ Performance optimized for mobile with connection pooling and async operations.
 
 from fastapi import FastAPI, HTTPException, Depends, Query, Header, Body, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import httpx
 import asyncio
 import re
 
 import os
+import time
 import json
 import hashlib
+import gzip
+import socket
 import string
 import random
+import base64
+from urllib.parse import quote
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from supabase_utils import get_supabase_config, sanitize_text
+from product_utils import DEFAULT_CHANNELS, REGIONS, normalize_region, product_from_row
 from functools import lru_cache
 from contextlib import asynccontextmanager
+from collections import deque, OrderedDict
 
 # --- HELPER: Robust Timestamp Parsing ---
 def safe_parse_dt(dt_str: str) -> Optional[datetime]:
@@ -56,8 +64,10 @@ async def lifespan(app: FastAPI):
     http_client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=True)
     print("[STARTUP] HTTP client initialized with connection pooling")
     
-    # Start background worker
+    # Start background workers
     asyncio.create_task(background_notification_worker())
+    asyncio.create_task(expo_receipt_poller())
+    asyncio.create_task(hot_feed_follower())
     
     yield
 
@@ -73,43 +83,73 @@ HEADERS = {'apikey': KEY, 'Authorization': f'Bearer {KEY}', 'Content-Type': 'app
 
 # Global storage for push tokens (Move to DB irl)
 USER_PUSH_TOKENS = {} # {user_id: [tokens]}
-LAST_PUSH_CHECK_TIME = datetime.now(timezone.utc)
-
-
-DEFAULT_CHANNELS = [
-    {"id": "1367813504786108526", "name": "Collectors Amazon", "url": "https://discord.com/channels/653646362453213205/1367813504786108526", "category": "UK Stores", "enabled": True},
-    {"id": "855164313006505994", "name": "Argos Instore", "url": "https://discord.com/channels/653646362453213205/855164313006505994", "category": "UK Stores", "enabled": True},
-    {"id": "864504557903937587", "name": "Restocks Online", "url": "https://discord.com/channels/653646362453213205/864504557903937587", "category": "UK Stores", "enabled": True},
-    {"id": "1385348512681689118", "name": "Amazon", "category": "USA Stores", "enabled": True},
-    {"id": "1384205489679892540", "name": "Walmart", "category": "USA Stores", "enabled": True},
-    {"id": "1391616295560155177", "name": "Pokemon Center", "category": "Canada Stores", "enabled": True},
-    {"id": "1406802285337776210", "name": "Hobbiesville", "category": "Canada Stores", "enabled": True}
-]
-
-@lru_cache(maxsize=1024)
-def optimize_image_url(url: str) -> str:
-    if not url: return url
-    try:
-        if "images-ext-" in url and "discordapp.net" in url:
-            if "/https/" in url: url = "https://" + url.split("/https/", 1)[1]
-            elif "/http/" in url: url = "http://" + url.split("/http/", 1)[1]
-        if any(domain in url for domain in ['media-amazon.com', 'images-amazon.com', 'ssl-images-amazon.com']):
-            url = re.sub(r'\._[A-Z_]+[0-9]+_\.', '.', url)
-            if "?" in url: url = url.split("?")[0]
-        if "ebayimg.com" in url:
-            if re.search(r's-l\d+\.', url): url = re.sub(r's-l\d+\.', 's-l1600.', url)
-            if "?" in url: url = url.split("?")[0]
-        if "discordapp.net" in url and "?" in url: url = url.split("?")[0]
-    except: pass
-    return url
 
-async def get_user_by_id(user_id: str) -> Optional[Dict]:
+
+
+# --- ASYNC TTL CACHE (LRU + single-flight) ---
+class AsyncTTLCache:
+    """
+    Results live for `ttl` seconds with LRU eviction beyond `size` entries, and
+    concurrent misses for the same key share one in-flight computation.
+    """
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.inflight: Dict[Any, asyncio.Future] = {}  # invalidate() detaches a load so its stale result isn't stored
+
+    async def get(self, key, compute):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            return entry[1]
+        task = self.inflight.get(key)
+        if task is None:
+            # The load is its own task: a caller that disconnects only cancels its wait, not everyone's
+            task = asyncio.ensure_future(self._load(key, compute))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # mark retrieved when nobody waited
+            self.inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key, compute):
+        task = asyncio.current_task()
+        try:
+            value = await compute()
+            if value is not None and self.inflight.get(key) is task: self.set(key, value)
+            return value
+        finally:
+            if self.inflight.get(key) is task: self.inflight.pop(key, None)
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.inflight.pop(key, None)
+
+# --- USER CACHE ---
+# Columns the hot path (feed gating, status, link checks) reads; anything else needs full=True
+USER_HOT_SELECT = "id,email,subscription_status,subscription_end,daily_free_alerts_viewed,email_verified"
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+user_cache = AsyncTTLCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+def cache_user(user: Optional[Dict]):
+    if user and user.get("id"): user_cache.set(str(user["id"]), {k: user.get(k) for k in USER_HOT_SELECT.split(",")})
+
+async def _fetch_user(user_id: str, select: str) -> Optional[Dict]:
     try:
-        response = await http_client.get(f"{URL}/rest/v1/users?id=eq.{user_id}&select=*", headers=HEADERS)
+        response = await http_client.get(f"{URL}/rest/v1/users?id=eq.{user_id}&select={select}", headers=HEADERS)
         if response.status_code == 200 and response.json(): return response.json()[0]
     except Exception as e: print(f"[DB] Error fetching user: {e}")
     return None
 
+async def get_user_by_id(user_id: str, full: bool = False) -> Optional[Dict]:
+    if full: return await _fetch_user(user_id, "*")
+    return await user_cache.get(str(user_id), lambda: _fetch_user(user_id, USER_HOT_SELECT))
+
 async def get_user_by_email(email: str) -> Optional[Dict]:
     try:
         response = await http_client.get(f"{URL}/rest/v1/users?email=eq.{email}&select=*", headers=HEADERS)
@@ -123,7 +163,9 @@ async def create_user(email: str = None, apple_id: str = None) -> Optional[Dict]
         response = await http_client.post(f"{URL}/rest/v1/users", headers=HEADERS, json=payload)
         if response.status_code in [200, 201]:
             result = response.json()
-            return result[0] if isinstance(result, list) and len(result) > 0 else result
+            user = result[0] if isinstance(result, list) and len(result) > 0 else result
+            cache_user(user)
+            return user
     except Exception as e: print(f"[DB] Error creating user: {e}")
     return None
 
@@ -131,6 +173,8 @@ async def update_user(user_id: str, data: Dict) -> bool:
     try:
         data["updated_at"] = datetime.now(timezone.utc).isoformat()
         response = await http_client.patch(f"{URL}/rest/v1/users?id=eq.{user_id}", headers=HEADERS, json=data)
+        user_cache.invalidate(str(user_id))
+        if response.status_code == 200 and response.json(): cache_user(response.json()[0])
         return response.status_code in [200, 201, 204]
     except Exception as e: print(f"[DB] Error updating user: {e}")
     return False
@@ -262,6 +306,7 @@ async def signup(data: Dict = Body(...)):
         response = await http_client.post(f"{URL}/rest/v1/users", headers=HEADERS, json=payload)
         if response.status_code in [200, 201]:
             user = response.json()[0] if isinstance(response.json(), list) else response.json()
+            cache_user(user)
             # Trigger verification email
             await trigger_email_verification(email)
             return {"success": True, "user": {"id": user["id"], "email": user["email"], "isPremium": user.get("subscription_status") == "active", "email_verified": False}}
@@ -401,7 +446,7 @@ async def register_push_token(user_id: str = Query(...), token: str = Query(...)
     
     # 2. Update Supabase (Primary)
     # Fetch current tokens first
-    user = await get_user_by_id(user_id)
+    user = await get_user_by_id(user_id, full=True)
     if user:
         current_tokens = user.get("push_tokens") or []
         if not isinstance(current_tokens, list): current_tokens = []
@@ -409,6 +454,9 @@ async def register_push_token(user_id: str = Query(...), token: str = Query(...)
             current_tokens.append(token)
             await update_user(user_id, {"push_tokens": current_tokens})
             print(f"[PUSH] Registered token for user {user_id} in DB")
+        push_routes.set_user(user_id, current_tokens, user.get("notification_preferences"))
+    else:
+        push_routes.set_user(user_id, USER_PUSH_TOKENS[user_id])
             
     return {"success": True}
 
@@ -419,6 +467,9 @@ async def update_preferences(user_id: str = Query(...), data: Dict = Body(...)):
     
     # data format: {"enabled": bool, "regions": {"USA Stores": ["ALL"], ...}}
     success = await update_user(user_id, {"notification_preferences": data})
+    if success:
+        tokens = push_routes.users.get(str(user_id), (USER_PUSH_TOKENS.get(user_id, []), []))[0]
+        push_routes.set_user(user_id, tokens, data)
     return {"success": success}
 
 @app.post("/v1/user/change-password")
@@ -431,7 +482,7 @@ async def change_password(data: Dict = Body(...)):
     if not user_id or not old_password or not new_password:
         raise HTTPException(status_code=400, detail="Missing fields")
         
-    user = await get_user_by_id(user_id)
+    user = await get_user_by_id(user_id, full=True)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
         
@@ -453,31 +504,136 @@ async def change_password(data: Dict = Body(...)):
         raise HTTPException(status_code=500, detail="Failed to update password")
 
 # Sends push notification via Expo Push API
-async def send_expo_push_notification(tokens: List[str], title: str, body: str, data: Dict = None):
+# --- EXPO PUSH DELIVERY ---
+EXPO_PUSH_URL = "https://exp.host/--/api/v2/push/send"
+EXPO_RECEIPTS_URL = "https://exp.host/--/api/v2/push/getReceipts"
+EXPO_CHUNK_SIZE = 100  # Expo rejects requests with more than 100 messages
+EXPO_RECEIPT_CHUNK_SIZE = 1000
+EXPO_CONCURRENCY = int(os.getenv("EXPO_CONCURRENCY", "4"))
+EXPO_RECEIPT_DELAY = float(os.getenv("EXPO_RECEIPT_DELAY", "900"))  # Expo keeps receipts ~24h; they're ready after ~15min
+EXPO_RECEIPT_TTL = timedelta(hours=24)  # tickets still without a receipt after this are given up
+EXPO_HEADERS = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate", "Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+expo_semaphore = asyncio.Semaphore(EXPO_CONCURRENCY)
+
+async def _post_expo(url: str, payload) -> Optional[Dict]:
+    async with expo_semaphore:
+        response = await http_client.post(url, headers=EXPO_HEADERS, content=gzip.compress(json.dumps(payload).encode()))
+    if response.status_code != 200:
+        print(f"[PUSH] Expo error {response.status_code}: {response.text[:200]}")
+        return None
+    return response.json()
+
+async def _send_expo_chunk(tokens: List[str], message: Dict) -> tuple:
+    """Send one <=100 token chunk; returns (tokens Expo reported as no longer registered, [(token, ticket id)])"""
+    dead, tickets = [], []
+    try:
+        result = await _post_expo(EXPO_PUSH_URL, [dict(message, to=token) for token in tokens])
+        if not result: return dead, tickets
+        for token, ticket in zip(tokens, result.get("data") or []):
+            if ticket.get("status") == "ok" and ticket.get("id"): tickets.append((token, ticket["id"]))
+            elif (ticket.get("details") or {}).get("error") == "DeviceNotRegistered": dead.append(token)
+    except Exception as e:
+        print(f"[PUSH] Error sending push chunk: {e}")
+    return dead, tickets
+
+async def store_push_tickets(message_id, tickets: List[tuple]):
+    """Keep tickets on their push_deliveries rows so receipt checks survive restarts"""
+    rows = [{"message_id": int(message_id), "token": token, "ticket_id": ticket_id} for token, ticket_id in tickets]
+    try:
+        headers = {**HEADERS, "Prefer": "resolution=merge-duplicates,return=minimal"}
+        response = await http_client.post(f"{URL}/rest/v1/push_deliveries?on_conflict=message_id,token", headers=headers, json=rows)
+        if response.status_code not in [200, 201, 204]: print(f"[PUSH] Ticket store failed ({response.status_code}): {response.text[:200]}")
+    except Exception as e: print(f"[PUSH] Ticket store error: {e}")
+
+async def send_expo_push_notification(tokens: List[str], title: str, body: str, data: Dict = None, message_id=None):
     if not tokens: return
     
     message = {
-        "to": tokens,
         "sound": "default",
         "title": title,
         "body": body,
         "data": data or {},
         "badge": 1
     }
-
-    try:
-        response = await http_client.post(
-            "https://exp.host/--/api/v2/push/send",
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-            },
-            json=message
-        )
+    chunks = [tokens[i:i + EXPO_CHUNK_SIZE] for i in range(0, len(tokens), EXPO_CHUNK_SIZE)]
+    results = await asyncio.gather(*[_send_expo_chunk(chunk, message) for chunk in chunks])
+    dead = [token for chunk_dead, _ in results for token in chunk_dead]
+    tickets = [ticket for _, chunk_tickets in results for ticket in chunk_tickets]
+    if tickets and message_id is not None: await store_push_tickets(message_id, tickets)
+    if dead: await prune_push_tokens(dead)
+
+async def check_expo_receipts():
+    """
+    Fetch receipts for stored tickets old enough to have one and prune DeviceNotRegistered
+    tokens. Tickets Expo has no receipt for yet stay pending (until EXPO_RECEIPT_TTL).
+    """
+    now = datetime.now(timezone.utc)
+    ready_before = quote((now - timedelta(seconds=EXPO_RECEIPT_DELAY)).isoformat())
+    expired_before = now - EXPO_RECEIPT_TTL
+    dead, offset = [], 0
+    while True:
+        response = await http_client.get(
+            f"{URL}/rest/v1/push_deliveries?select=token,ticket_id,sent_at&ticket_id=not.is.null&sent_at=lt.{ready_before}"
+            f"&order=sent_at.asc&limit={EXPO_RECEIPT_CHUNK_SIZE}&offset={offset}", headers=HEADERS)
         if response.status_code != 200:
-            print(f"[PUSH] Expo error: {response.text}")
-    except Exception as e:
-        print(f"[PUSH] Error sending push: {e}")
+            print(f"[PUSH] Pending tickets query failed: {response.status_code}")
+            break
+        rows = response.json()
+        if not rows: break
+        result = await _post_expo(EXPO_RECEIPTS_URL, {"ids": [row["ticket_id"] for row in rows]})
+        if result is None: break
+        receipts = result.get("data") or {}
+        checked = []
+        for row in rows:
+            receipt = receipts.get(row["ticket_id"])
+            if receipt is None:
+                # Not ready yet: keep it for the next pass unless Expo has long since dropped it
+                sent_at = safe_parse_dt(row.get("sent_at"))
+                if sent_at and sent_at < expired_before: checked.append(row["ticket_id"])
+                continue
+            checked.append(row["ticket_id"])
+            if receipt.get("status") == "error":
+                error = (receipt.get("details") or {}).get("error")
+                if error == "DeviceNotRegistered": dead.append(row["token"])
+                else: print(f"[PUSH] Delivery error for ticket {row['ticket_id']}: {error or receipt.get('message')}")
+        if checked:
+            ids = ",".join(f'"{ticket_id}"' for ticket_id in checked)
+            await http_client.patch(f"{URL}/rest/v1/push_deliveries?ticket_id=in.({quote(ids)})", headers=HEADERS, json={"ticket_id": None})
+        # Rows left pending are still at the head of the query; step past them
+        offset += len(rows) - len(checked)
+        if len(rows) < EXPO_RECEIPT_CHUNK_SIZE: break
+    if dead: await prune_push_tokens(dead)
+
+async def expo_receipt_poller():
+    while True:
+        await asyncio.sleep(60)
+        try: await check_expo_receipts()
+        except Exception as e: print(f"[PUSH] Receipt poller error: {e}")
+
+async def prune_push_tokens(tokens: List[str]):
+    """Remove unregistered device tokens from users.push_tokens, the local token file and the routing index"""
+    dead = set(tokens)
+    owners = push_routes.drop_tokens(dead)
+    changed = False
+    for uid, user_tokens in list(USER_PUSH_TOKENS.items()):
+        kept = [t for t in user_tokens if t not in dead]
+        if len(kept) != len(user_tokens):
+            USER_PUSH_TOKENS[uid] = kept
+            owners.add(uid)
+            changed = True
+    if changed:
+        try:
+            os.makedirs("data", exist_ok=True)
+            with open("data/push_tokens.json", "w") as f:
+                json.dump(USER_PUSH_TOKENS, f)
+        except: pass
+    for uid in owners:
+        user = await get_user_by_id(uid, full=True)
+        current_tokens = (user or {}).get("push_tokens")
+        if isinstance(current_tokens, list) and any(t in dead for t in current_tokens):
+            await update_user(uid, {"push_tokens": [t for t in current_tokens if t not in dead]})
+    print(f"[PUSH] Pruned {len(dead)} unregistered token(s)")
 
 
 # --- BOT USERS CACHE ---
@@ -624,10 +780,252 @@ async def unlink_telegram_endpoint(data: Dict = Body(...)):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+# --- PUSH NOTIFICATION WORKER ---
+# Only the columns a push notification is built from
+PUSH_SELECT = "id,region,category_name,title,price,was_price,resell,scraped_at"
+PUSH_CURSOR_FILE = "data/push_cursor.json"
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "100"))
+PUSH_POLL_SECONDS = float(os.getenv("PUSH_POLL_SECONDS", "60"))
+
+def load_push_cursor() -> Optional[tuple]:
+    try:
+        if os.path.exists(PUSH_CURSOR_FILE):
+            with open(PUSH_CURSOR_FILE, "r") as f: data = json.load(f)
+            return data["scraped_at"], int(data["id"])
+    except Exception as e: print(f"[PUSH] Cursor load error: {e}")
+    return None
+
+def save_push_cursor(cursor: tuple):
+    try:
+        os.makedirs("data", exist_ok=True)
+        tmp_path = PUSH_CURSOR_FILE + ".tmp"
+        with open(tmp_path, "w") as f: json.dump({"scraped_at": cursor[0], "id": cursor[1]}, f)
+        os.replace(tmp_path, PUSH_CURSOR_FILE)
+    except Exception as e: print(f"[PUSH] Cursor save error: {e}")
+
+async def fetch_push_batch(cursor: Optional[tuple]) -> Optional[List[Dict]]:
+    """Next PUSH_BATCH_SIZE products strictly after the cursor, oldest first (None on error)"""
+    query = f"select={PUSH_SELECT}&order=scraped_at.asc,id.asc&limit={PUSH_BATCH_SIZE}"
+    if cursor: query += f"&or=({keyset_newer_filter(cursor)})"
+    response = await http_client.get(f"{URL}/rest/v1/products?{query}", headers=HEADERS)
+    if response.status_code != 200:
+        print(f"[PUSH] Products query failed: {response.status_code}")
+        return None
+    return response.json()
+
+async def latest_push_cursor() -> Optional[tuple]:
+    """Cursor just before the newest product, so the first batch starts with it (no history beyond it)"""
+    response = await http_client.get(f"{URL}/rest/v1/products?select=id,scraped_at&order=scraped_at.desc,id.desc&limit=1", headers=HEADERS)
+    if response.status_code == 200 and response.json():
+        row = response.json()[0]
+        return row["scraped_at"], int(row["id"]) - 1
+    return None
+
+def build_push_message(msg: Dict) -> tuple:
+    """(title, body) for a product row"""
+    msg_region = msg.get("region") or "USA Stores"
+    
+    # Professional Formatting
+    title = msg.get("title") or "New Deal Detected!"
+    if len(title) > 50: title = title[:47] + "..."
+    
+    # Generate sleek title with discount info
+    raw_was = str(msg.get("was_price") or msg.get("resell") or "")
+    raw_now = str(msg.get("price") or "")
+    
+    # Try to detect discount for the title
+    prefix = "🔥"
+    try:
+        price_val = float(re.sub(r'[^0-9.]', '', raw_now)) if raw_now else 0
+        was_val = float(re.sub(r'[^0-9.]', '', raw_was)) if raw_was else 0
+        if was_val > price_val and price_val > 0:
+            discount = int(((was_val - price_val) / was_val) * 100)
+            if discount >= 10:
+                prefix = f"📉 {discount}% OFF"
+    except: pass
+    
+    return f"{prefix}: {title}", f"New drop in {msg_region}! Tap to grab this deal before it sells out."
+
+class PushRoutingIndex:
+    """
+    (region, category) -> user ids, plus (region, 'ALL') and a wildcard bucket for
+    users without region preferences. Targeting a product is a set union instead
+    of a scan over every user's preferences.
+    """
+    WILDCARD = ("*", "*")
+
+    def __init__(self):
+        self.users: Dict[str, tuple] = {}  # user_id -> (tokens, route keys)
+        self.routes: Dict[tuple, set] = {}
+        self.ready = False
+        self.synced_at: Optional[str] = None  # newest users.updated_at applied
+        self.rebuilt_at = 0.0  # time.monotonic() of the last full rebuild
+
+    @staticmethod
+    def _route_keys(prefs: Optional[Dict]) -> List[tuple]:
+        prefs = prefs or {}
+        # Check master toggle (if stored in prefs)
+        if prefs.get("enabled") == False: return []
+        # Format: {"USA Stores": ["ALL"], "UK Stores": ["flips"]}
+        user_regions = prefs.get("regions") or {}
+        # Default: notify everyone if no prefs set
+        if not user_regions: return [PushRoutingIndex.WILDCARD]
+        keys = []
+        for region, cats in user_regions.items():
+            cats = cats or []
+            keys.extend([(region, "ALL")] if "ALL" in cats else [(region, cat) for cat in cats])
+        return keys
+
+    def set_user(self, user_id: str, tokens=None, prefs: Optional[Dict] = None):
+        user_id = str(user_id)
+        self.remove_user(user_id)
+        tokens = tokens if isinstance(tokens, list) else ([tokens] if tokens else [])
+        keys = self._route_keys(prefs)
+        # Tokens cleared or notifications switched off: the user leaves the index
+        if not tokens or not keys: return
+        self.users[user_id] = (tokens, keys)
+        for key in keys: self.routes.setdefault(key, set()).add(user_id)
+
+    def remove_user(self, user_id: str):
+        tokens, keys = self.users.pop(str(user_id), ([], []))
+        for key in keys:
+            bucket = self.routes.get(key)
+            if bucket is None: continue
+            bucket.discard(str(user_id))
+            if not bucket: del self.routes[key]
+
+    def rebuild(self, users_data: List[Dict]):
+        self.users, self.routes = {}, {}
+        for u in users_data: self.set_user(u.get("id"), u.get("push_tokens"), u.get("notification_preferences"))
+        self.ready = True
+        self.rebuilt_at = time.monotonic()
+
+    def drop_tokens(self, dead: set) -> set:
+        """Forget dead tokens; returns the ids of users that held them"""
+        owners = set()
+        for uid, (tokens, keys) in list(self.users.items()):
+            if not any(t in dead for t in tokens): continue
+            owners.add(uid)
+            kept = [t for t in tokens if t not in dead]
+            if kept: self.users[uid] = (kept, keys)
+            else: self.remove_user(uid)
+        return owners
+
+    def targets(self, region: str, category: str) -> List[str]:
+        user_ids = set()
+        for key in (self.WILDCARD, (region, "ALL"), (region, category)): user_ids |= self.routes.get(key, set())
+        return list({token for uid in user_ids for token in self.users[uid][0]})
+
+push_routes = PushRoutingIndex()
+
+def push_targets(msg: Dict) -> List[str]:
+    """Tokens of users whose preferences match the product's region/category"""
+    return push_routes.targets(msg.get("region") or "USA Stores", msg.get("category_name") or "General")
+
+PUSH_USER_SELECT = "id,notification_preferences,push_tokens,updated_at"
+PUSH_USER_PAGE = 1000
+PUSH_FULL_SYNC_SECONDS = float(os.getenv("PUSH_FULL_SYNC_SECONDS", "3600"))
+
+async def _fetch_push_users(since: Optional[str]) -> Optional[List[Dict]]:
+    """Users changed at/after `since` (all users when None), paged; None if the columns aren't there"""
+    rows, offset = [], 0
+    while True:
+        query = f"select={PUSH_USER_SELECT}&order=updated_at.asc,id.asc&limit={PUSH_USER_PAGE}&offset={offset}"
+        if since: query += f"&updated_at=gte.{quote(since)}"
+        response = await http_client.get(f"{URL}/rest/v1/users?{query}", headers=HEADERS)
+        if response.status_code != 200:
+            # Fallback to local memory tokens if DB columns aren't ready yet
+            # Only log this once per restart to avoid spam
+            if 'MIGRATION_WARNED' not in globals():
+                print(f"[PUSH] Warning: User preferences DB columns missing (Status {response.status_code}). Using local cache.")
+                print(f"       Please run the SQL migration to enable cloud sync.")
+                globals()['MIGRATION_WARNED'] = True
+            return None
+        page = response.json()
+        rows.extend(page)
+        if len(page) < PUSH_USER_PAGE: return rows
+        offset += len(page)
+
+async def sync_push_users():
+    """
+    Keep the routing index in step with the users table. The first call loads
+    everyone; later calls only fetch rows whose updated_at moved since the last
+    sync, so steady-state cost follows the number of changes, not of users.
+    Deleted users never show up as changed rows, so the index is rebuilt from a
+    full read every PUSH_FULL_SYNC_SECONDS.
+    """
+    full = not push_routes.ready or time.monotonic() - push_routes.rebuilt_at >= PUSH_FULL_SYNC_SECONDS
+    rows = await _fetch_push_users(None if full else push_routes.synced_at)
+    if rows is None:
+        if not push_routes.ready:
+            push_routes.rebuild([{"id": uid, "push_tokens": tokens, "notification_preferences": {}} for uid, tokens in USER_PUSH_TOKENS.items()])
+        return
+    if full: push_routes.rebuild(rows)
+    else:
+        for u in rows: push_routes.set_user(u.get("id"), u.get("push_tokens"), u.get("notification_preferences"))
+    stamps = [u["updated_at"] for u in rows if u.get("updated_at")]
+    if stamps: push_routes.synced_at = max(stamps, key=lambda ts: safe_parse_dt(ts) or datetime.min.replace(tzinfo=timezone.utc))
+    if rows and push_routes.ready: print(f"[PUSH] Synced {len(rows)} user(s) into the routing index")
+
+# --- WORKER LEASE + DELIVERY LEDGER (one push worker across replicas) ---
+PUSH_LEASE_NAME = "push_worker"
+PUSH_LEASE_TTL = int(os.getenv("PUSH_LEASE_TTL", "180"))
+PUSH_LEDGER_RETENTION = timedelta(days=7)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{random.randrange(16 ** 6):06x}"
+
+async def acquire_worker_lease(name: str) -> bool:
+    """Take or renew the named lease; only one process holds it until it stops heartbeating"""
+    try:
+        payload = {"p_name": name, "p_holder": WORKER_ID, "p_ttl_seconds": PUSH_LEASE_TTL}
+        response = await http_client.post(f"{URL}/rest/v1/rpc/acquire_worker_lease", headers=HEADERS, json=payload)
+        if response.status_code == 200: return bool(response.json())
+        print(f"[LEASE] Acquire failed: {response.status_code} {response.text[:200]}")
+    except Exception as e: print(f"[LEASE] Acquire error: {e}")
+    return False
+
+async def load_lease_cursor(name: str) -> Optional[tuple]:
+    """Cursor stored on the lease row by the previous holder (survives failover to another host)"""
+    try:
+        response = await http_client.get(f"{URL}/rest/v1/worker_leases?name=eq.{name}&select=cursor", headers=HEADERS)
+        if response.status_code == 200 and response.json():
+            data = response.json()[0].get("cursor")
+            if data: return data["scraped_at"], int(data["id"])
+    except Exception as e: print(f"[LEASE] Cursor load error: {e}")
+    return None
+
+async def store_lease_cursor(name: str, cursor: tuple):
+    try:
+        await http_client.patch(f"{URL}/rest/v1/worker_leases?name=eq.{name}&holder=eq.{quote(WORKER_ID)}", headers=HEADERS, json={"cursor": {"scraped_at": cursor[0], "id": cursor[1]}})
+    except Exception as e: print(f"[LEASE] Cursor store error: {e}")
+
+async def claim_push_deliveries(message_id, tokens: List[str]) -> List[str]:
+    """
+    Record (message, token) pairs in the delivery ledger and return only the ones
+    that weren't there yet, so a re-run after failover never notifies twice.
+    """
+    rows = [{"message_id": int(message_id), "token": token} for token in tokens]
+    try:
+        headers = dict(HEADERS, Prefer="resolution=ignore-duplicates,return=representation")
+        response = await http_client.post(f"{URL}/rest/v1/push_deliveries?select=token", headers=headers, json=rows)
+        if response.status_code in [200, 201]: return [row["token"] for row in response.json()]
+        print(f"[PUSH] Ledger write failed ({response.status_code}); sending without dedup")
+    except Exception as e: print(f"[PUSH] Ledger error: {e}; sending without dedup")
+    return tokens
+
+async def prune_push_ledger():
+    cutoff = (datetime.now(timezone.utc) - PUSH_LEDGER_RETENTION).isoformat()
+    try: await http_client.delete(f"{URL}/rest/v1/push_deliveries?sent_at=lt.{quote(cutoff)}", headers=HEADERS)
+    except Exception as e: print(f"[PUSH] Ledger prune error: {e}")
+
 async def background_notification_worker():
-    """Background task to poll for new products and notify users"""
-    global LAST_PUSH_CHECK_TIME
-    print("[PUSH] Worker started")
+    """
+    Background task that notifies users about every new product.
+    Walks the products table from a persisted (scraped_at, id) cursor in
+    PUSH_BATCH_SIZE pages, so bursts between ticks are delivered in full and
+    restarts resume where the last run stopped. Every replica runs this loop,
+    but only the holder of the push_worker lease sends anything.
+    """
+    print(f"[PUSH] Worker started ({WORKER_ID})")
     
     # Load tokens from file at startup
     global USER_PUSH_TOKENS
@@ -637,101 +1035,58 @@ async def background_notification_worker():
                 USER_PUSH_TOKENS = json.load(f)
     except: pass
 
+    cursor = None
+    is_leader = False
+    last_ledger_prune = 0.0
     while True:
         try:
-            await asyncio.sleep(60) # Check every 60 seconds
-            
-            # 1. Fetch all users with push tokens and their preferences
-            response = await http_client.get(f"{URL}/rest/v1/users?select=id,notification_preferences,push_tokens", headers=HEADERS)
-            
-            users_data = []
-            if response.status_code == 200:
-                users_data = response.json()
-            else:
-                # Fallback to local memory tokens if DB columns aren't ready yet
-                # Only log this once per restart to avoid spam
-                if 'MIGRATION_WARNED' not in globals():
-                    print(f"[PUSH] Warning: User preferences DB columns missing (Status {response.status_code}). Using local cache.")
-                    print(f"       Please run the SQL migration to enable cloud sync.")
-                    globals()['MIGRATION_WARNED'] = True
-                
-                for uid, tokens in USER_PUSH_TOKENS.items():
-                    users_data.append({"id": uid, "push_tokens": tokens, "notification_preferences": {}})
-            
-            if not users_data:
-                await asyncio.sleep(60)
+            await asyncio.sleep(PUSH_POLL_SECONDS)
+            if not await acquire_worker_lease(PUSH_LEASE_NAME):
+                if is_leader: print("[PUSH] Lost push worker lease; standing by")
+                is_leader = False
+                continue
+            if not is_leader:
+                # Newly elected: resume from the shared cursor, falling back to our own file
+                print("[PUSH] Acquired push worker lease")
+                is_leader = True
+                cursor = await load_lease_cursor(PUSH_LEASE_NAME) or load_push_cursor()
+            if not cursor:
+                # First run: start at the newest product instead of notifying history
+                cursor = await latest_push_cursor()
+                if cursor:
+                    save_push_cursor(cursor)
+                    await store_lease_cursor(PUSH_LEASE_NAME, cursor)
                 continue
+            if time.monotonic() - last_ledger_prune > 3600:
+                last_ledger_prune = time.monotonic()
+                await prune_push_ledger()
 
-            # 2. Get latest products since LAST_PUSH_CHECK_TIME
-            # We check the last 5 messages to ensure we don't miss any during worker overlap
-            query = f"order=scraped_at.desc&limit=5"
-            response = await http_client.get(f"{URL}/rest/v1/discord_messages?{query}", headers=HEADERS)
-            if response.status_code == 200 and response.json():
-                messages = response.json()
-                new_messages = []
-                for m in messages:
-                    dt = safe_parse_dt(m.get("scraped_at"))
-                    if dt and dt > LAST_PUSH_CHECK_TIME:
-                        new_messages.append(m)
-                
-                if new_messages:
-                    print(f"[PUSH] {len(new_messages)} new product(s) detected. Processing notifications...")
-                    
-                    for msg in new_messages:
-                        msg_region = msg.get("region", "USA Stores")
-                        msg_category = msg.get("category_name", "General")
-                        product_data = msg.get("product_data", {})
-                        
-                        # Professional Formatting
-                        title = product_data.get("title", "New Deal Detected!")
-                        if len(title) > 50: title = title[:47] + "..."
-                        
-                        # Generate sleek title with discount info
-                        raw_was = str(product_data.get("was_price", "") or product_data.get("resell_price", ""))
-                        raw_now = str(product_data.get("price", ""))
-                        
-                        # Try to detect discount for the title
-                        prefix = "🔥"
-                        try:
-                            price_val = float(re.sub(r'[^0-9.]', '', raw_now)) if raw_now else 0
-                            was_val = float(re.sub(r'[^0-9.]', '', raw_was)) if raw_was else 0
-                            if was_val > price_val and price_val > 0:
-                                discount = int(((was_val - price_val) / was_val) * 100)
-                                if discount >= 10:
-                                    prefix = f"📉 {discount}% OFF"
-                        except: pass
-                        
-                        final_title = f"{prefix}: {title}"
-                        body = f"New drop in {msg_region}! Tap to grab this deal before it sells out."
-                        
-                        # Target specific users based on preferences
-                        target_tokens = []
-                        for u in users_data:
-                            prefs = u.get("notification_preferences") or {}
-                            tokens = u.get("push_tokens")
-                            if not tokens: continue
-                            
-                            # Check master toggle (if stored in prefs)
-                            if prefs.get("enabled") == False: continue
-                            
-                            # Check region/category filtering
-                            # Format: {"USA Stores": ["ALL"], "UK Stores": ["flips"]}
-                            user_regions = prefs.get("regions", {})
-                            if not user_regions: 
-                                # Default: notify everyone if no prefs set (or you could be strict)
-                                target_tokens.extend(tokens if isinstance(tokens, list) else [tokens])
-                                continue
-                                
-                            if msg_region in user_regions:
-                                allowed_cats = user_regions[msg_region]
-                                if "ALL" in allowed_cats or msg_category in allowed_cats:
-                                    target_tokens.extend(tokens if isinstance(tokens, list) else [tokens])
-                        
-                        if target_tokens:
-                            print(f"[PUSH] Sending to {len(set(target_tokens))} devices...")
-                            await send_expo_push_notification(list(set(target_tokens)), final_title, body, {"product_id": msg["id"]})
-                    
-                    LAST_PUSH_CHECK_TIME = now
+            batch = await fetch_push_batch(cursor)
+            if not batch: continue
+            
+            # Users are only looked at when there is something to send
+            await sync_push_users()
+            sent = 0
+            while batch:
+                print(f"[PUSH] {len(batch)} new product(s) detected. Processing notifications...")
+                for msg in batch:
+                    target_tokens = push_targets(msg)
+                    if target_tokens: target_tokens = await claim_push_deliveries(msg["id"], target_tokens)
+                    if target_tokens:
+                        title, body = build_push_message(msg)
+                        await send_expo_push_notification(target_tokens, title, body, {"product_id": str(msg["id"])}, message_id=msg["id"])
+                        sent += 1
+                    cursor = (msg["scraped_at"], int(msg["id"]))
+                save_push_cursor(cursor)
+                await store_lease_cursor(PUSH_LEASE_NAME, cursor)
+                if len(batch) < PUSH_BATCH_SIZE: break
+                # Heartbeat between batches; stop if another replica took over
+                if not await acquire_worker_lease(PUSH_LEASE_NAME):
+                    print("[PUSH] Lost push worker lease mid-run; standing by")
+                    is_leader = False
+                    break
+                batch = await fetch_push_batch(cursor)
+            print(f"[PUSH] Caught up to {cursor[0]} ({sent} notification(s) sent)")
         except Exception as e:
             print(f"[PUSH] Worker error: {e}")
 
@@ -776,324 +1131,366 @@ async def apple_signin(data: Dict = Body(...)):
         print(f"[AUTH] Apple signin error: {e}")
         raise HTTPException(status_code=500, detail=f"Error with Apple sign-in: {str(e)}")
 
-def _clean_text_for_sig(text: str) -> str:
-    if not text: return ""
-    text = re.sub(r'<@&?\d+>|<#\d+>', '', text)
-    text = re.sub(r'@[A-Za-z0-9_]+\b', '', text)
-    text = text.replace('|', '').replace('[', '').replace(']', '')
-    return " ".join(text.lower().split()).strip()
-
-def _get_content_signature(msg: Dict) -> str:
-    try:
-        raw = msg.get("raw_data", {})
-        embed = raw.get("embed") or {}
-        content = msg.get("content", "")
-        retailer = embed.get("author", {}).get("name", "") if embed.get("author") else ""
-        title = embed.get("title", "")
-        price = ""
-        for field in embed.get("fields", []):
-            name = (field.get("name") or "").lower()
-            if "price" in name:
-                price = field.get("value", "")
-                break
-        if not retailer or not title or not price:
-            if content and "|" in content:
-                parts = [p.strip() for p in content.split("|")]
-                if len(parts) >= 2:
-                    price_match = re.search(r'[£$€]\s*[\d,]+\.?\d*', content)
-                    if price_match: price = price_match.group(0)
-                    if not title: title = parts[0]
-                    if not retailer and len(parts) > 1: retailer = parts[1]
-        if not retailer and "Argos" in content: retailer = "Argos Instore"
-        c_retailer = _clean_text_for_sig(retailer)
-        c_title = _clean_text_for_sig(title)
-        f_title = c_title[:25].strip()
-        num_match = re.search(r'[\d,]+\.?\d*', price)
-        c_price = num_match.group(0).replace(',', '') if num_match else price.strip()
-        raw_sig = f"{c_retailer}|{f_title}|{c_price}"
-        if len(raw_sig) < 8: return hashlib.md5(content.encode()).hexdigest() if content else str(msg.get("id"))
-        return hashlib.md5(raw_sig.encode()).hexdigest()
-    except: return str(msg.get("id"))
-
-def _clean_display_text(text: str) -> str:
-    if not text: return ""
-    text = re.sub(r'<@&?\d+>|<#\d+>', '', text)
-    text = re.sub(r'^[ \t]*@[A-Za-z0-9_ ]+([|:-]|$)', '', text)
-    text = re.sub(r'@[A-Za-z0-9_]+\b', '', text)
-    text = text.strip().strip('|').strip(':').strip('-').strip()
-    return text
-
-def extract_product(msg, channel_map):
-    raw = msg.get("raw_data", {})
-    embeds = raw.get("embeds", [])
-    embed = raw.get("embed") or (embeds[0] if embeds else {})
-    ch_id = str(msg.get("channel_id", ""))
-    ch_info = channel_map.get(ch_id)
-    if not ch_info: return None
-    raw_region = ch_info.get('category', 'USA Stores').strip()
-    upper_reg = raw_region.upper()
-    if 'UK' in upper_reg: msg_region = 'UK Stores'
-    elif 'CANADA' in upper_reg: msg_region = 'Canada Stores'
-    else: msg_region = 'USA Stores'
-    subcategory = ch_info.get('name', 'Unknown')
-    raw_title = embed.get("title") or msg.get("content", "")[:100] or "HollowScan Product"
-    title = _clean_display_text(raw_title)
-    if not title: title = "HollowScan Product"
-    description = embed.get("description") or ""
-    if not description and msg.get("content"):
-        description = re.sub(r'<@&?\d+>', '', msg.get("content", "")).strip()
-        description = re.sub(r'\[([^\]]+)\]\((https?://[^\)]+)\)', r'\1', description)
-    image = None
-    if embed.get("images"): image = optimize_image_url(embed["images"][0])
-    elif embed.get("image") and isinstance(embed["image"], dict): image = optimize_image_url(embed["image"].get("url"))
-    elif embed.get("thumbnail") and isinstance(embed["thumbnail"], dict): image = optimize_image_url(embed["thumbnail"].get("url"))
-    if not image and embeds:
-        for extra_embed in embeds:
-            if extra_embed.get("images"): image = optimize_image_url(extra_embed["images"][0]); break
-            elif extra_embed.get("image") and isinstance(extra_embed["image"], dict): image = optimize_image_url(extra_embed["image"].get("url")); break
-            elif extra_embed.get("thumbnail") and isinstance(extra_embed["thumbnail"], dict): image = optimize_image_url(extra_embed["thumbnail"].get("url")); break
-    if not image and raw.get("attachments"):
-        for att in raw["attachments"]:
-            if any(att.get("filename", "").lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.webp']): image = att.get("url"); break
-    if not image and msg.get("content"):
-        img_match = re.search(r'(https?://[^\s]+(?:\.png|\.jpg|\.jpeg|\.webp))', msg["content"], re.IGNORECASE)
-        if img_match: image = img_match.group(1)
-    price, resell, roi, was_price = None, None, None, None
-    details = []
-    product_data_updates = {}
-    if embed.get("fields"):
-        for field in embed["fields"]:
-            name = (field.get("name") or "").strip()
-            val = (field.get("value") or "").strip()
-            if not name or not val: continue
-            if "[" in val and "](" in val: continue
-            name_lower = name.lower()
-            matches = re.findall(r'[\d,.]+', val)
-            num = matches[-1].replace(',', '') if matches else None
-            is_redundant = False
-            if num:
-                if any(k in name_lower for k in ["price", "retail", "cost"]):
-                    if not price:
-                        price = num
-                        if "~~" in val or "(" in val: product_data_updates["price_display"] = val
-                    is_redundant = True
-                elif any(k in name_lower for k in ["resell", "resale", "sell"]):
-                    if not resell: resell = num
-                    is_redundant = True
-                elif "roi" in name_lower or "profit" in name_lower:
-                    if not roi: roi = num
-                    is_redundant = True
-                elif any(k in name_lower for k in ["was", "before", "original"]):
-                    if not was_price: was_price = num
-                    is_redundant = True
-            if not is_redundant: details.append({"label": name, "value": val})
-    all_links = []
-    if embed.get("title_url"): all_links.append({"url": embed["title_url"], "text": "Link"})
-    if embed.get("fields"):
-        for field in embed["fields"]:
-            val = field.get("value", "")
-            matches = re.findall(r'\[([^\]]+)\]\((https?://[^\)]+)\)', val)
-            for text, url in matches: all_links.append({"url": url, "text": text})
-    categorized_links = {"buy": [], "ebay": [], "fba": [], "other": []}
-    primary_buy_url = None
-    for link in all_links:
-        url, text = link.get('url', ''), (link.get('text') or 'Link').strip()
-        if not url: continue
-        link_obj = {"text": text, "url": url}
-        u_low, t_low = url.lower(), text.lower()
-        if any(k in t_low or k in u_low for k in ['buy', 'shop', 'purchase', 'checkout', 'cart', 'link']):
-            categorized_links["buy"].append(link_obj)
-            if not primary_buy_url: primary_buy_url = url
-        elif any(k in t_low or k in u_low for k in ['sold', 'active', 'google', 'ebay']): categorized_links["ebay"].append(link_obj)
-        elif any(k in t_low or k in u_low for k in ['keepa', 'amazon', 'selleramp', 'fba', 'camel']): categorized_links["fba"].append(link_obj)
-        else: categorized_links["other"].append(link_obj)
-    components = raw.get("components", [])
-    for comp_row in components:
-        sub_comps = comp_row.get("components", [])
-        for comp in sub_comps:
-            url = comp.get("url")
-            label = comp.get("label") or "Link"
-            if url and url.startswith("http"):
-                link_obj = {"text": label, "url": url}
-                u_low, t_low = url.lower(), label.lower()
-                if any(ext['url'] == url for sub in categorized_links.values() for ext in sub): continue
-                if any(k in t_low or k in u_low for k in ['buy', 'shop', 'purchase', 'checkout', 'cart', 'link']):
-                    categorized_links["buy"].append(link_obj)
-                    if not primary_buy_url: primary_buy_url = url
-                elif any(k in t_low or k in u_low for k in ['sold', 'active', 'google', 'ebay']): categorized_links["ebay"].append(link_obj)
-                elif any(k in t_low or k in u_low for k in ['keepa', 'amazon', 'selleramp', 'fba', 'camel']): categorized_links["fba"].append(link_obj)
-                else: categorized_links["other"].append(link_obj)
-    if not primary_buy_url and embed.get("fields"):
-         for field in embed["fields"]:
-             link_match = re.search(r'\[([^\]]+)\]\((https?://[^\)]+)\)', field.get("value", ""))
-             if link_match: primary_buy_url = link_match.group(2); break
-    product_data = {
-        "title": title[:100], "description": description[:500],
-        "image": image or "https://via.placeholder.com/400",
-        "price": price, "was_price": was_price, "resell": resell, "roi": roi,
-        "buy_url": primary_buy_url or (all_links[0].get('url') if all_links else None),
-        "links": categorized_links, "details": details
-    }
-    product_data.update(product_data_updates)
-    return {"id": str(msg.get("id")), "region": msg_region, "category_name": subcategory, "product_data": product_data, "created_at": msg.get("scraped_at"), "is_locked": False}
-
 @app.get("/")
 async def root():
     return {"status": "online", "app": "hollowScan API", "v": "1.0.0"}
 
-@app.get("/v1/categories")
-async def get_categories():
-    result = {}
-    channels = []
-    source = "none"
-    try:
-        storage_url = f"{URL}/storage/v1/object/authenticated/monitor-data/discord_josh/channels.json"
-        channels_response = await http_client.get(storage_url, headers=HEADERS)
-        if channels_response.status_code == 200:
-            channels = channels_response.json() or []
-            source = "remote"
-            print(f"[CATEGORIES] ✓ Loaded {len(channels)} channels from remote")
-    except Exception as e: print(f"[CATEGORIES] ✗ Remote channels fetch failed: {type(e).__name__}: {e}")
-    if not channels:
+# --- CHANNEL REGISTRY (channels.json cached with ETag revalidation) ---
+CHANNELS_STORAGE_URL = f"{URL}/storage/v1/object/authenticated/monitor-data/discord_josh/channels.json"
+CHANNEL_REVALIDATE_SECONDS = float(os.getenv("CHANNEL_REVALIDATE_SECONDS", "5"))
+
+class ChannelRegistry:
+    """
+    Process-wide view of channels.json. Revalidated with a conditional GET at most
+    every CHANNEL_REVALIDATE_SECONDS; lookup tables are rebuilt only when the file changes.
+    """
+    def __init__(self):
+        self.channels: List[Dict] = []
+        self.source = "none"
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.store_names: Dict[tuple, str] = {}     # (region, STORE) -> display store name
+        self.categories: Dict[str, List[str]] = {}
+
+    def _load_local(self) -> List[Dict]:
         for filename in ["data/channels_.json", "data/channels.json", "channels.json"]:
             if os.path.exists(filename):
                 try:
                     with open(filename, "r") as f: channels = json.load(f)
-                    if channels: break
+                    if channels: return channels
                 except: continue
-    if not channels:
-        channels = DEFAULT_CHANNELS
-        source = "defaults"
-    result = {"UK Stores": [], "USA Stores": [], "Canada Stores": []}
-    for channel in channels:
-        if not channel.get('enabled', True): continue
-        region_name = channel.get('category', 'USA Stores').strip()
-        store_name = channel.get('name', 'Unknown')
-        upper_reg = region_name.upper()
-        if 'UK' in upper_reg: region_name = 'UK Stores'
-        elif 'CANADA' in upper_reg: region_name = 'Canada Stores'
-        elif 'USA' in upper_reg or 'UNITED STATES' in upper_reg or upper_reg.startswith('US'): region_name = 'USA Stores'
-        else: region_name = 'USA Stores'
-        if store_name not in result[region_name]: result[region_name].append(store_name)
-    for region in result:
-        result[region] = sorted(result[region])
-        result[region].insert(0, "ALL")
-    return {"categories": result, "source": source, "channel_count": len(channels)}
+        return []
+
+    def _rebuild(self, channels: List[Dict], source: str):
+        store_names = {}
+        for channel in channels:
+            if not channel.get('enabled', True): continue
+            region = normalize_region(channel.get('category', 'USA Stores'))
+            store = channel.get('name', 'Unknown').strip()
+            store_names.setdefault((region, store.upper()), store)
+        categories = {r: ["ALL"] + sorted({store for (reg, _), store in store_names.items() if reg == r}) for r in REGIONS}
+        self.channels, self.source = channels, source
+        self.store_names, self.categories = store_names, categories
+        print(f"[CHANNELS] ✓ Registry rebuilt from {source}: {len(channels)} channels")
+
+    async def refresh(self):
+        if time.monotonic() - self.checked_at < CHANNEL_REVALIDATE_SECONDS and self.channels: return
+        async with self.lock:
+            if time.monotonic() - self.checked_at < CHANNEL_REVALIDATE_SECONDS and self.channels: return
+            self.checked_at = time.monotonic()
+            headers = dict(HEADERS)
+            if self.etag: headers["If-None-Match"] = self.etag
+            if self.last_modified: headers["If-Modified-Since"] = self.last_modified
+            try:
+                response = await http_client.get(CHANNELS_STORAGE_URL, headers=headers)
+                if response.status_code == 304 and self.channels: return
+                if response.status_code == 200:
+                    channels = response.json() or []
+                    if channels:
+                        self.etag = response.headers.get("ETag")
+                        self.last_modified = response.headers.get("Last-Modified")
+                        self._rebuild(channels, "remote")
+                        return
+            except Exception as e: print(f"[CHANNELS] ✗ Remote channels fetch failed: {type(e).__name__}: {e}")
+            if self.channels: return  # keep serving the last good copy
+            channels = self._load_local()
+            if channels: self._rebuild(channels, "local")
+            else: self._rebuild(DEFAULT_CHANNELS, "defaults")
+
+    def canonical_store(self, region: str, store: str) -> Optional[str]:
+        return self.store_names.get((region, store.strip().upper()))
+
+channel_registry = ChannelRegistry()
 
-@app.get("/v1/feed")
-async def get_feed(user_id: str, region: Optional[str] = "ALL", category: Optional[str] = "ALL", offset: int = 0, limit: int = 20, country: Optional[str] = None, search: Optional[str] = None):
-    if country and (not region or region == "ALL"): region = country
-    channels = []
+@app.get("/v1/categories")
+async def get_categories():
+    await channel_registry.refresh()
+    return {"categories": channel_registry.categories, "source": channel_registry.source, "channel_count": len(channel_registry.channels)}
+
+# Columns the feed needs from the materialized 'products' table
+FEED_SELECT = "id,region,category_name,product_data,signature,scraped_at"
+
+# --- FEED CURSORS ---
+# Opaque keyset cursor over (scraped_at, id). Page N costs the same as page 1
+# and new inserts at the head of the feed no longer shift later pages.
+def encode_feed_cursor(scraped_at: str, row_id) -> str:
+    raw = json.dumps([scraped_at, str(row_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_feed_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    if not cursor: return None
     try:
-        storage_url = f"{URL}/storage/v1/object/authenticated/monitor-data/discord_josh/channels.json"
-        channels_response = await http_client.get(storage_url, headers=HEADERS)
-        if channels_response.status_code == 200: channels = channels_response.json() or []
-    except: pass
-    if not channels:
-        for filename in ["data/channels_.json", "data/channels.json", "channels.json"]:
-            if os.path.exists(filename):
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        scraped_at, row_id = json.loads(raw)
+        return scraped_at, int(row_id)
+    except Exception:
+        return None
+
+def keyset_filter(after: tuple) -> str:
+    """PostgREST logic expression for rows strictly older than the cursor in (scraped_at desc, id desc) order"""
+    ts = quote(f'"{after[0]}"')
+    return f"or(scraped_at.lt.{ts},and(scraped_at.eq.{ts},id.lt.{after[1]}))"
+
+def keyset_newer_filter(after: tuple) -> str:
+    """Inner of an or=(...) filter for rows strictly newer than the cursor in (scraped_at, id) order"""
+    ts = quote(f'"{after[0]}"')
+    return f"scraped_at.gt.{ts},and(scraped_at.eq.{ts},id.gt.{after[1]})"
+
+# --- FEED SEARCH (products.search_vector via the search_products RPC) ---
+def build_search_query(search: Optional[str]) -> Optional[str]:
+    """Prefix tsquery for the search box: 'nike dunk' -> 'nike:* & dunk:*'"""
+    if not search: return None
+    keywords = [k.lower() for k in re.findall(r"\w+", search) if len(k) > 1]
+    return " & ".join(f"{k}:*" for k in keywords) or None
+
+async def search_feed(search_query: str, search_text: str, region: Optional[str], store: Optional[str], offset: int, limit: int) -> Dict:
+    payload = {"p_query": search_query, "p_text": search_text, "p_region": region, "p_category": store, "p_limit": limit, "p_offset": offset}
+    products, seen_signatures, rows = [], set(), []
+    try:
+        response = await http_client.post(f"{URL}/rest/v1/rpc/search_products", headers=HEADERS, json=payload)
+        if response.status_code == 200: rows = response.json() or []
+        else: print(f"[FEED] Search RPC failed: {response.status_code} {response.text[:200]}")
+    except Exception as e: print(f"[FEED] Search error: {e}")
+    for row in rows:
+        sig = row.get("signature") or str(row.get("id"))
+        if sig in seen_signatures: continue
+        seen_signatures.add(sig)
+        products.append(product_from_row(row))
+    print(f"[FEED] Search '{search_query}' returned {len(products)} products.")
+    return {"products": products, "next_offset": str(offset + len(rows)), "next_cursor": None, "has_more": len(rows) >= limit}
+
+# --- FEED PAGE CACHE (single-flight + short TTL, shared by all users) ---
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "3"))
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "512"))
+
+# Keys never include the user; per-user trimming happens on the way out
+feed_cache = AsyncTTLCache(FEED_CACHE_TTL, FEED_CACHE_SIZE)
+
+# --- HOT FEED (In-memory ring of the newest products per region/category) ---
+HOT_FEED_SIZE = int(os.getenv("HOT_FEED_SIZE", "100"))
+HOT_FEED_POLL_SECONDS = float(os.getenv("HOT_FEED_POLL_SECONDS", "3"))
+
+class HotFeed:
+    """
+    Bounded rings of the most recent product rows, keyed by (region, CATEGORY).
+    ('ALL', 'ALL') and (region, 'ALL') buckets are kept as well so first-page
+    feed requests can be answered without touching Supabase.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.buckets: Dict[tuple, deque] = {}
+        self.newest: Optional[tuple] = None  # (scraped_at, id) of the newest row seen
+        self.ready = False
+
+    def _keys(self, row: Dict) -> List[tuple]:
+        region = row.get("region") or "USA Stores"
+        return [("ALL", "ALL"), (region, "ALL"), (region, (row.get("category_name") or "").upper())]
+
+    def add(self, row: Dict):
+        """Add a row that is newer than everything already in the rings"""
+        for key in self._keys(row):
+            if key not in self.buckets: self.buckets[key] = deque(maxlen=self.size)
+            self.buckets[key].appendleft(row)
+        self.newest = (row["scraped_at"], int(row["id"]))
+
+    def get_page(self, region: Optional[str], category: Optional[str], limit: int) -> Optional[tuple]:
+        """Returns (products, last_row) for a first page, or None if the ring can't fully answer it"""
+        if not self.ready: return None
+        key = ("ALL", "ALL")
+        if region and region.strip().upper() != "ALL":
+            key = (normalize_region(region), "ALL")
+            if category and category.strip().upper() != "ALL": key = (key[0], category.strip().upper())
+        bucket = self.buckets.get(key)
+        if not bucket: return None
+        products, seen_signatures, last_row = [], set(), None
+        for row in list(bucket):
+            last_row = row
+            sig = row.get("signature") or str(row.get("id"))
+            if sig in seen_signatures: continue
+            seen_signatures.add(sig)
+            products.append(product_from_row(row))
+            if len(products) >= limit: return products, last_row
+        return None
+
+hot_feed = HotFeed(HOT_FEED_SIZE)
+
+# --- LIVE PRODUCT STREAM (SSE fan-out of the hot feed tail) ---
+STREAM_QUEUE_SIZE = 50
+STREAM_KEEPALIVE_SECONDS = 15
+FREE_FEED_LIMIT = 4  # products a free user sees per feed page / stream connection
+
+class ProductStream:
+    """Fans new product rows out to connected /v1/stream clients, filtered per subscriber"""
+    def __init__(self):
+        self.subscribers: Dict[asyncio.Queue, tuple] = {}
+
+    def subscribe(self, region: Optional[str], category: Optional[str]) -> asyncio.Queue:
+        want_region = normalize_region(region) if region and region.strip().upper() != "ALL" else "ALL"
+        want_category = category.strip().upper() if want_region != "ALL" and category and category.strip().upper() != "ALL" else "ALL"
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.subscribers[queue] = (want_region, want_category)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.pop(queue, None)
+
+    def publish(self, row: Dict):
+        if not self.subscribers: return
+        region = row.get("region")
+        category = (row.get("category_name") or "").upper()
+        payload = None
+        for queue, (want_region, want_category) in self.subscribers.items():
+            if want_region != "ALL" and want_region != region: continue
+            if want_category != "ALL" and want_category != category: continue
+            if payload is None: payload = json.dumps(product_from_row(row))
+            if queue.full():
+                # Slow client: drop its oldest pending product rather than block the tail
+                try: queue.get_nowait()
+                except asyncio.QueueEmpty: pass
+            queue.put_nowait(payload)
+
+product_stream = ProductStream()
+
+async def hot_feed_follower():
+    """Seed the hot feed, then tail the products table by (scraped_at, id)"""
+    print("[HOT FEED] Follower started")
+    while not hot_feed.ready:
+        try:
+            response = await http_client.get(f"{URL}/rest/v1/products?select={FEED_SELECT}&order=scraped_at.desc,id.desc&limit={HOT_FEED_SIZE * 10}", headers=HEADERS)
+            if response.status_code == 200:
+                for row in reversed(response.json()): hot_feed.add(row)
+                hot_feed.ready = True
+                print(f"[HOT FEED] Seeded {len(hot_feed.buckets)} buckets")
+                break
+            print(f"[HOT FEED] Seed failed: {response.status_code}")
+        except Exception as e: print(f"[HOT FEED] Seed error: {e}")
+        await asyncio.sleep(30)
+    while True:
+        await asyncio.sleep(HOT_FEED_POLL_SECONDS)
+        try:
+            query = f"select={FEED_SELECT}&order=scraped_at.asc,id.asc&limit=200"
+            if hot_feed.newest: query += f"&or=({keyset_newer_filter(hot_feed.newest)})"
+            response = await http_client.get(f"{URL}/rest/v1/products?{query}", headers=HEADERS)
+            if response.status_code != 200: continue
+            for row in response.json():
+                hot_feed.add(row)
+                product_stream.publish(row)
+        except Exception as e: print(f"[HOT FEED] Follow error: {e}")
+
+@app.get("/v1/stream")
+async def stream_products(user_id: str, region: Optional[str] = "ALL", category: Optional[str] = "ALL", country: Optional[str] = None):
+    """Server-sent events stream of newly extracted products (replaces client-side feed polling)"""
+    user = await get_user_by_id(user_id)
+    if not user: raise HTTPException(status_code=404, detail="User not found")
+    # Same gating as /v1/feed: free users get FREE_FEED_LIMIT products, then the stream ends
+    premium_user = user.get("subscription_status") == "active"
+    if country and (not region or region == "ALL"): region = country
+    queue = product_stream.subscribe(region, category)
+
+    async def events():
+        sent = 0
+        try:
+            yield "retry: 5000\n\n"
+            while True:
                 try:
-                    with open(filename, "r") as f: channels = json.load(f)
-                    if channels: break
-                except: continue
-    if not channels: channels = DEFAULT_CHANNELS
-    channel_map = {}
-    for c in channels:
-        if c.get('enabled', True): channel_map[c['id']] = {'category': c.get('category', 'USA Stores').strip(), 'name': c.get('name', 'Unknown').strip()}
-    for c in DEFAULT_CHANNELS:
-        if c['id'] not in channel_map: channel_map[c['id']] = {'category': c.get('category', 'USA Stores').strip(), 'name': c.get('name', 'Unknown').strip()}
-    target_ids = []
-    if region and region.strip().upper() != "ALL":
-        req_reg = region.strip().upper()
-        if 'UK' in req_reg: norm_reg = 'UK'
-        elif 'CANADA' in req_reg or 'CA' in req_reg: norm_reg = 'CANADA'
-        else: norm_reg = 'USA'
-        for c in channels:
-            c_cat = (c.get('category') or '').upper()
-            c_name = (c.get('name') or '').upper()
-            is_region_match = norm_reg in c_cat or (norm_reg == 'USA' and 'US' in c_cat)
-            if category and category.strip().upper() != "ALL":
-                if is_region_match and c_name == category.strip().upper(): target_ids.append(c['id'])
-            elif is_region_match: target_ids.append(c['id'])
-    id_filter = ""
-    if target_ids: id_filter = f"&channel_id=in.({','.join(target_ids)})"
+                    payload = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                    yield f"event: product\ndata: {payload}\n\n"
+                    sent += 1
+                    if not premium_user and sent >= FREE_FEED_LIMIT:
+                        yield f"event: limit\ndata: {json.dumps({'is_premium': False, 'limit': FREE_FEED_LIMIT})}\n\n"
+                        return
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            product_stream.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/v1/feed")
+async def get_feed(user_id: str, region: Optional[str] = "ALL", category: Optional[str] = "ALL", offset: Optional[str] = "0", limit: int = 20, country: Optional[str] = None, search: Optional[str] = None, cursor: Optional[str] = None):
+    if country and (not region or region == "ALL"): region = country
+    # 'offset' carries either a legacy integer (older app builds) or the opaque cursor we returned in next_offset
+    legacy_offset = 0
+    after = decode_feed_cursor(cursor)
+    if not after and offset:
+        if str(offset).isdigit(): legacy_offset = int(offset)
+        else: after = decode_feed_cursor(offset)
+    is_first_page = not after and legacy_offset == 0
     premium_user = False
     try:
         user = await get_user_by_id(user_id)
         if user and user.get("subscription_status") == "active": premium_user = True
     except Exception as e: print(f"[FEED] Quota check error: {e}")
+    if not premium_user and not is_first_page:
+        # Free tier only ever sees the first FREE_FEED_LIMIT products
+        return {"products": [], "next_offset": offset, "has_more": False, "is_premium": False, "total_count": FREE_FEED_LIMIT}
+    canonical_region = normalize_region(region) if region and region.strip().upper() != "ALL" else None
+    store = category.strip() if canonical_region and category and category.strip().upper() != "ALL" else None
+    if store:
+        await channel_registry.refresh()
+        store = channel_registry.canonical_store(canonical_region, store) or store
+    search_query = build_search_query(search)
+    search_text = (search or "").strip()
+    # The raw text feeds the trigram fallback, so it is part of the key alongside the normalized query
+    key = (canonical_region, store.upper() if store else None, search_query, search_text if search_query else "", after, legacy_offset, limit)
+    page = await feed_cache.get(key, lambda: build_feed_page(canonical_region, store, search_query, search_text, after, legacy_offset, limit))
+    products = page["products"] if premium_user else page["products"][:FREE_FEED_LIMIT]
+    return {"products": products, "next_offset": page["next_offset"] or offset, "next_cursor": page["next_cursor"], "has_more": premium_user and page["has_more"], "is_premium": premium_user, "total_count": 100}
+
+async def build_feed_page(region: Optional[str], store: Optional[str], search_query: Optional[str], search_text: str, after: Optional[tuple], legacy_offset: int, limit: int) -> Dict:
+    """One feed page for everyone asking the same question; the caller applies per-user trimming"""
+    if search_query:
+        return await search_feed(search_query, search_text, region, store, legacy_offset, limit)
+    if not after and legacy_offset == 0:
+        hot_page = hot_feed.get_page(region or "ALL", store or "ALL", limit)
+        if hot_page:
+            products, last_row = hot_page
+            next_cursor = encode_feed_cursor(last_row["scraped_at"], last_row["id"])
+            return {"products": products, "next_offset": next_cursor, "next_cursor": next_cursor, "has_more": True}
+    filters = ""
+    if region:
+        filters += f"&region=eq.{quote(region)}"
+        if store:
+            # Known stores match exactly (index-friendly); unknown names keep the case-insensitive match
+            known = channel_registry.canonical_store(region, store)
+            filters += f"&category_name=eq.{quote(known)}" if known else f"&category_name=ilike.{quote(store)}"
     all_products = []
     seen_signatures = set()
-    current_sql_offset = offset
+    rows_read = 0
+    last_row = None
     chunks_scanned = 0
-    base_max = 12 if premium_user else 6
-    max_chunks = base_max * 8 if search else base_max
+    max_chunks = 4
     while len(all_products) < limit and chunks_scanned < max_chunks:
         batch_limit = 50
-        query = f"order=scraped_at.desc&offset={current_sql_offset}&limit={batch_limit}{id_filter}"
-        if search and search.strip():
-            keywords = [k.strip() for k in search.split() if len(k.strip()) > 1]
-            if keywords:
-                or_parts = []
-                for k in keywords:
-                    or_parts.append(f"content.ilike.*{k}*")
-                    or_parts.append(f"raw_data->embeds->0->>title.ilike.*{k}*")
-                    or_parts.append(f"raw_data->embeds->0->>description.ilike.*{k}*")
-                query += f"&or=({','.join(or_parts)})"
+        query = f"select={FEED_SELECT}&order=scraped_at.desc,id.desc&limit={batch_limit}{filters}"
+        if after: query += f"&and=({keyset_filter(after)})"
+        if legacy_offset: query += f"&offset={legacy_offset + rows_read}"
         try:
-            response = await http_client.get(f"{URL}/rest/v1/discord_messages?{query}", headers=HEADERS)
-            if response.status_code != 200: break
-            messages = response.json()
-            if not messages: break
-            for msg in messages:
-                sig = _get_content_signature(msg)
+            response = await http_client.get(f"{URL}/rest/v1/products?{query}", headers=HEADERS)
+            if response.status_code != 200:
+                print(f"[FEED] Products query failed: {response.status_code} {response.text[:200]}")
+                break
+            rows = response.json()
+            if not rows: break
+            for row in rows:
+                rows_read += 1
+                last_row = row
+                sig = row.get("signature") or str(row.get("id"))
                 if sig in seen_signatures: continue
-                prod = extract_product(msg, channel_map)
-                if not prod: continue
-                p_data = prod.get("product_data", {})
-                price_val = p_data.get("price")
-                resale_val = p_data.get("resell")
-                was_val = p_data.get("was_price")
-                has_image = p_data.get("image") and "placeholder" not in p_data.get("image")
-                has_links = bool(p_data.get("buy_url") or (p_data.get("links") and any(p_data["links"].values())))
-                try:
-                    p_num = float(str(price_val or 0).replace(',', ''))
-                    r_num = float(str(resale_val or 0).replace(',', ''))
-                    w_num = float(str(was_val or 0).replace(',', ''))
-                    has_any_price = p_num > 0 or r_num > 0 or w_num > 0
-                except (ValueError, TypeError): has_any_price = bool(price_val or resale_val or was_val)
-                if not has_image and not has_links and not has_any_price: continue
-                if search and search.strip():
-                    search_keywords = [k.lower().strip() for k in search.split() if k.strip()]
-                    title_low = prod["product_data"]["title"].lower()
-                    desc_low = prod["product_data"]["description"].lower()
-                    cat_low = prod["category_name"].lower()
-                    ret_low = (prod.get("product_data", {}).get("retailer") or "").lower()
-                    match_found = False
-                    for kw in search_keywords:
-                        if kw in title_low or kw in desc_low or kw in cat_low or kw in ret_low:
-                            match_found = True
-                            break
-                    if not match_found: continue
-                if region and region.strip().upper() != "ALL":
-                    if prod["region"].strip() != region.strip(): continue
-                if category and category.strip().upper() != "ALL":
-                    if prod["category_name"].upper().strip() != category.upper().strip(): continue
-                all_products.append(prod)
                 seen_signatures.add(sig)
+                all_products.append(product_from_row(row))
                 if len(all_products) >= limit: break
-            current_sql_offset += len(messages)
             chunks_scanned += 1
-            if len(messages) < batch_limit: break
+            if not legacy_offset: after = (last_row["scraped_at"], int(last_row["id"]))
+            if len(rows) < batch_limit: break
         except Exception as e:
             print(f"[FEED] Error in batch fetch: {e}")
             break
-    if not premium_user:
-        if offset >= 4: return {"products": [], "next_offset": offset, "has_more": False, "is_premium": False, "total_count": offset + len(all_products)}
-        all_products = all_products[:4 - offset]
-        for product in all_products: product["is_locked"] = False
-    print(f"[FEED] Scan complete. Found {len(all_products)} products after scanning {current_sql_offset - offset} messages.")
-    return {"products": all_products, "next_offset": current_sql_offset, "has_more": premium_user and (len(all_products) >= limit), "is_premium": premium_user, "total_count": 100}
+    next_cursor = encode_feed_cursor(last_row["scraped_at"], last_row["id"]) if last_row else None
+    print(f"[FEED] Found {len(all_products)} products after reading {rows_read} rows.")
+    return {"products": all_products, "next_offset": next_cursor, "next_cursor": next_cursor, "has_more": len(all_products) >= limit}
 
 @app.get("/v1/user/status")
 async def get_user_status(user_id: str):
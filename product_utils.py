@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+product_utils.py
+Shared product extraction for Discord messages.
+Used at ingest time (supabase_utils) to materialize the 'products' table
+and by main_api for anything that still needs to parse raw messages.
+"""
+
+import re
+import hashlib
+from functools import lru_cache
+from typing import List, Optional, Dict, Any
+
+
+DEFAULT_CHANNELS = [
+    {"id": "1367813504786108526", "name": "Collectors Amazon", "url": "https://discord.com/channels/653646362453213205/1367813504786108526", "category": "UK Stores", "enabled": True},
+    {"id": "855164313006505994", "name": "Argos Instore", "url": "https://discord.com/channels/653646362453213205/855164313006505994", "category": "UK Stores", "enabled": True},
+    {"id": "864504557903937587", "name": "Restocks Online", "url": "https://discord.com/channels/653646362453213205/864504557903937587", "category": "UK Stores", "enabled": True},
+    {"id": "1385348512681689118", "name": "Amazon", "category": "USA Stores", "enabled": True},
+    {"id": "1384205489679892540", "name": "Walmart", "category": "USA Stores", "enabled": True},
+    {"id": "1391616295560155177", "name": "Pokemon Center", "category": "Canada Stores", "enabled": True},
+    {"id": "1406802285337776210", "name": "Hobbiesville", "category": "Canada Stores", "enabled": True}
+]
+
+REGIONS = ["UK Stores", "USA Stores", "Canada Stores"]
+
+def normalize_region(raw_region: Optional[str]) -> str:
+    """Map a channel category or request region ('UK', 'US Stores', 'CA'...) to a canonical region name"""
+    upper_reg = (raw_region or "").strip().upper()
+    if 'UK' in upper_reg: return 'UK Stores'
+    if 'CANADA' in upper_reg or upper_reg == 'CA' or upper_reg.startswith('CA '): return 'Canada Stores'
+    return 'USA Stores'
+
+def build_channel_map(channels: List[Dict]) -> Dict[str, Dict]:
+    """channel_id -> {'category', 'name'} for enabled channels, padded with DEFAULT_CHANNELS"""
+    channel_map = {}
+    for c in channels or []:
+        if c.get('enabled', True): channel_map[str(c['id'])] = {'category': c.get('category', 'USA Stores').strip(), 'name': c.get('name', 'Unknown').strip()}
+    for c in DEFAULT_CHANNELS:
+        if c['id'] not in channel_map: channel_map[c['id']] = {'category': c.get('category', 'USA Stores').strip(), 'name': c.get('name', 'Unknown').strip()}
+    return channel_map
+
+@lru_cache(maxsize=1024)
+def optimize_image_url(url: str) -> str:
+    if not url: return url
+    try:
+        if "images-ext-" in url and "discordapp.net" in url:
+            if "/https/" in url: url = "https://" + url.split("/https/", 1)[1]
+            elif "/http/" in url: url = "http://" + url.split("/http/", 1)[1]
+        if any(domain in url for domain in ['media-amazon.com', 'images-amazon.com', 'ssl-images-amazon.com']):
+            url = re.sub(r'\._[A-Z_]+[0-9]+_\.', '.', url)
+            if "?" in url: url = url.split("?")[0]
+        if "ebayimg.com" in url:
+            if re.search(r's-l\d+\.', url): url = re.sub(r's-l\d+\.', 's-l1600.', url)
+            if "?" in url: url = url.split("?")[0]
+        if "discordapp.net" in url and "?" in url: url = url.split("?")[0]
+    except: pass
+    return url
+
+def _clean_text_for_sig(text: str) -> str:
+    if not text: return ""
+    text = re.sub(r'<@&?\d+>|<#\d+>', '', text)
+    text = re.sub(r'@[A-Za-z0-9_]+\b', '', text)
+    text = text.replace('|', '').replace('[', '').replace(']', '')
+    return " ".join(text.lower().split()).strip()
+
+def get_content_signature(msg: Dict) -> str:
+    """
+    Retailer + title + price fingerprint used for duplicate detection.
+    Computed once at ingest and stored on discord_messages/products; the bot and
+    the API read the stored value and only fall back to this for legacy rows.
+    """
+    if msg.get("signature"): return msg["signature"]
+    try:
+        raw = msg.get("raw_data", {})
+        embed = raw.get("embed") or {}
+        content = msg.get("content", "")
+        retailer = embed.get("author", {}).get("name", "") if embed.get("author") else ""
+        title = embed.get("title", "")
+        price = ""
+        for field in embed.get("fields", []):
+            name = (field.get("name") or "").lower()
+            if "price" in name:
+                price = field.get("value", "")
+                break
+        if not retailer or not title or not price:
+            if content and "|" in content:
+                parts = [p.strip() for p in content.split("|")]
+                if len(parts) >= 2:
+                    price_match = re.search(r'[£$€]\s*[\d,]+\.?\d*', content)
+                    if price_match: price = price_match.group(0)
+                    if not title: title = parts[0]
+                    if not retailer and len(parts) > 1: retailer = parts[1]
+        if not retailer and "Argos" in content: retailer = "Argos Instore"
+        c_retailer = _clean_text_for_sig(retailer)
+        c_title = _clean_text_for_sig(title)
+        f_title = c_title[:25].strip()
+        num_match = re.search(r'[\d,]+\.?\d*', price)
+        c_price = num_match.group(0).replace(',', '') if num_match else price.strip()
+        raw_sig = f"{c_retailer}|{f_title}|{c_price}"
+        if len(raw_sig) < 8: return hashlib.md5(content.encode()).hexdigest() if content else str(msg.get("id"))
+        return hashlib.md5(raw_sig.encode()).hexdigest()
+    except: return str(msg.get("id"))
+
+def _clean_display_text(text: str) -> str:
+    if not text: return ""
+    text = re.sub(r'<@&?\d+>|<#\d+>', '', text)
+    text = re.sub(r'^[ \t]*@[A-Za-z0-9_ ]+([|:-]|$)', '', text)
+    text = re.sub(r'@[A-Za-z0-9_]+\b', '', text)
+    text = text.strip().strip('|').strip(':').strip('-').strip()
+    return text
+
+def extract_product(msg, channel_map):
+    raw = msg.get("raw_data", {})
+    embeds = raw.get("embeds", [])
+    embed = raw.get("embed") or (embeds[0] if embeds else {})
+    ch_id = str(msg.get("channel_id", ""))
+    ch_info = channel_map.get(ch_id)
+    if not ch_info: return None
+    msg_region = normalize_region(ch_info.get('category', 'USA Stores'))
+    subcategory = ch_info.get('name', 'Unknown')
+    raw_title = embed.get("title") or msg.get("content", "")[:100] or "HollowScan Product"
+    title = _clean_display_text(raw_title)
+    if not title: title = "HollowScan Product"
+    description = embed.get("description") or ""
+    if not description and msg.get("content"):
+        description = re.sub(r'<@&?\d+>', '', msg.get("content", "")).strip()
+        description = re.sub(r'\[([^\]]+)\]\((https?://[^\)]+)\)', r'\1', description)
+    image = None
+    if embed.get("images"): image = optimize_image_url(embed["images"][0])
+    elif embed.get("image") and isinstance(embed["image"], dict): image = optimize_image_url(embed["image"].get("url"))
+    elif embed.get("thumbnail") and isinstance(embed["thumbnail"], dict): image = optimize_image_url(embed["thumbnail"].get("url"))
+    if not image and embeds:
+        for extra_embed in embeds:
+            if extra_embed.get("images"): image = optimize_image_url(extra_embed["images"][0]); break
+            elif extra_embed.get("image") and isinstance(extra_embed["image"], dict): image = optimize_image_url(extra_embed["image"].get("url")); break
+            elif extra_embed.get("thumbnail") and isinstance(extra_embed["thumbnail"], dict): image = optimize_image_url(extra_embed["thumbnail"].get("url")); break
+    if not image and raw.get("attachments"):
+        for att in raw["attachments"]:
+            if any(att.get("filename", "").lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.webp']): image = att.get("url"); break
+    if not image and msg.get("content"):
+        img_match = re.search(r'(https?://[^\s]+(?:\.png|\.jpg|\.jpeg|\.webp))', msg["content"], re.IGNORECASE)
+        if img_match: image = img_match.group(1)
+    price, resell, roi, was_price = None, None, None, None
+    details = []
+    product_data_updates = {}
+    if embed.get("fields"):
+        for field in embed["fields"]:
+            name = (field.get("name") or "").strip()
+            val = (field.get("value") or "").strip()
+            if not name or not val: continue
+            if "[" in val and "](" in val: continue
+            name_lower = name.lower()
+            matches = re.findall(r'[\d,.]+', val)
+            num = matches[-1].replace(',', '') if matches else None
+            is_redundant = False
+            if num:
+                if any(k in name_lower for k in ["price", "retail", "cost"]):
+                    if not price:
+                        price = num
+                        if "~~" in val or "(" in val: product_data_updates["price_display"] = val
+                    is_redundant = True
+                elif any(k in name_lower for k in ["resell", "resale", "sell"]):
+                    if not resell: resell = num
+                    is_redundant = True
+                elif "roi" in name_lower or "profit" in name_lower:
+                    if not roi: roi = num
+                    is_redundant = True
+                elif any(k in name_lower for k in ["was", "before", "original"]):
+                    if not was_price: was_price = num
+                    is_redundant = True
+            if not is_redundant: details.append({"label": name, "value": val})
+    all_links = []
+    if embed.get("title_url"): all_links.append({"url": embed["title_url"], "text": "Link"})
+    if embed.get("fields"):
+        for field in embed["fields"]:
+            val = field.get("value", "")
+            matches = re.findall(r'\[([^\]]+)\]\((https?://[^\)]+)\)', val)
+            for text, url in matches: all_links.append({"url": url, "text": text})
+    categorized_links = {"buy": [], "ebay": [], "fba": [], "other": []}
+    primary_buy_url = None
+    for link in all_links:
+        url, text = link.get('url', ''), (link.get('text') or 'Link').strip()
+        if not url: continue
+        link_obj = {"text": text, "url": url}
+        u_low, t_low = url.lower(), text.lower()
+        if any(k in t_low or k in u_low for k in ['buy', 'shop', 'purchase', 'checkout', 'cart', 'link']):
+            categorized_links["buy"].append(link_obj)
+            if not primary_buy_url: primary_buy_url = url
+        elif any(k in t_low or k in u_low for k in ['sold', 'active', 'google', 'ebay']): categorized_links["ebay"].append(link_obj)
+        elif any(k in t_low or k in u_low for k in ['keepa', 'amazon', 'selleramp', 'fba', 'camel']): categorized_links["fba"].append(link_obj)
+        else: categorized_links["other"].append(link_obj)
+    components = raw.get("components", [])
+    for comp_row in components:
+        sub_comps = comp_row.get("components", [])
+        for comp in sub_comps:
+            url = comp.get("url")
+            label = comp.get("label") or "Link"
+            if url and url.startswith("http"):
+                link_obj = {"text": label, "url": url}
+                u_low, t_low = url.lower(), label.lower()
+                if any(ext['url'] == url for sub in categorized_links.values() for ext in sub): continue
+                if any(k in t_low or k in u_low for k in ['buy', 'shop', 'purchase', 'checkout', 'cart', 'link']):
+                    categorized_links["buy"].append(link_obj)
+                    if not primary_buy_url: primary_buy_url = url
+                elif any(k in t_low or k in u_low for k in ['sold', 'active', 'google', 'ebay']): categorized_links["ebay"].append(link_obj)
+                elif any(k in t_low or k in u_low for k in ['keepa', 'amazon', 'selleramp', 'fba', 'camel']): categorized_links["fba"].append(link_obj)
+                else: categorized_links["other"].append(link_obj)
+    if not primary_buy_url and embed.get("fields"):
+         for field in embed["fields"]:
+             link_match = re.search(r'\[([^\]]+)\]\((https?://[^\)]+)\)', field.get("value", ""))
+             if link_match: primary_buy_url = link_match.group(2); break
+    product_data = {
+        "title": title[:100], "description": description[:500],
+        "image": image or "https://via.placeholder.com/400",
+        "price": price, "was_price": was_price, "resell": resell, "roi": roi,
+        "buy_url": primary_buy_url or (all_links[0].get('url') if all_links else None),
+        "links": categorized_links, "details": details
+    }
+    product_data.update(product_data_updates)
+    return {"id": str(msg.get("id")), "region": msg_region, "category_name": subcategory, "product_data": product_data, "created_at": msg.get("scraped_at"), "is_locked": False}
+
+def _to_number(value) -> Optional[float]:
+    try:
+        num = float(str(value).replace(',', ''))
+        return num if num > 0 else None
+    except (ValueError, TypeError): return None
+
+def is_feedable(prod: Dict) -> bool:
+    """A product is worth showing if it has at least a real image, a link or a price"""
+    p_data = prod.get("product_data", {})
+    has_image = p_data.get("image") and "placeholder" not in p_data.get("image")
+    has_links = bool(p_data.get("buy_url") or (p_data.get("links") and any(p_data["links"].values())))
+    has_any_price = any(_to_number(p_data.get(k)) for k in ("price", "resell", "was_price"))
+    return bool(has_image or has_links or has_any_price)
+
+def to_product_row(msg: Dict, channel_map: Dict[str, Dict]) -> Optional[Dict[str, Any]]:
+    """
+    Build a normalized 'products' row for a raw discord_messages row.
+    Returns None for unknown channels and for messages with nothing to show.
+    """
+    prod = extract_product(msg, channel_map)
+    if not prod or not is_feedable(prod): return None
+    p_data = prod["product_data"]
+    return {
+        "id": int(msg["id"]),
+        "channel_id": str(msg.get("channel_id", "")),
+        "region": prod["region"],
+        "category_name": prod["category_name"],
+        "title": p_data.get("title"),
+        "price": _to_number(p_data.get("price")),
+        "was_price": _to_number(p_data.get("was_price")),
+        "resell": _to_number(p_data.get("resell")),
+        "roi": _to_number(p_data.get("roi")),
+        "image": p_data.get("image"),
+        "buy_url": p_data.get("buy_url"),
+        "links": p_data.get("links"),
+        "product_data": p_data,
+        "signature": get_content_signature(msg),
+        "scraped_at": msg.get("scraped_at"),
+    }
+
+def product_from_row(row: Dict) -> Dict[str, Any]:
+    """Turn a 'products' row back into the feed item shape returned by extract_product"""
+    return {"id": str(row.get("id")), "region": row.get("region"), "category_name": row.get("category_name"), "product_data": row.get("product_data") or {}, "created_at": row.get("scraped_at"), "is_locked": False}
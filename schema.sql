@@ -4,6 +4,8 @@
 
 -- Enable UUID extension
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+-- Trigram matching for product search (partial words, typos)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 -- 1. USERS TABLE
 CREATE TABLE IF NOT EXISTS users (
@@ -83,6 +85,106 @@ CREATE TABLE IF NOT EXISTS alerts (
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- 6b. PRODUCTS TABLE (Materialized feed, written at ingest by supabase_utils.materialize_products)
+-- One row per extracted discord_messages row. /v1/feed reads this table directly
+-- instead of re-parsing raw_data on every request.
+CREATE TABLE IF NOT EXISTS products (
+    id BIGINT PRIMARY KEY, -- Same id as discord_messages.id
+    channel_id VARCHAR(50) NOT NULL,
+    region VARCHAR(50) NOT NULL, -- 'UK Stores', 'USA Stores', 'Canada Stores'
+    category_name VARCHAR(100) NOT NULL, -- Store / channel name
+    title TEXT,
+    price NUMERIC,
+    was_price NUMERIC,
+    resell NUMERIC,
+    roi NUMERIC,
+    image TEXT,
+    buy_url TEXT,
+    links JSONB DEFAULT '{}', -- {"buy": [], "ebay": [], "fba": [], "other": []}
+    product_data JSONB NOT NULL, -- Exact payload served to the app
+    signature VARCHAR(64),
+    scraped_at TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- 6b-2. CONTENT SIGNATURES
+-- Retailer/title/price fingerprint (product_utils.get_content_signature), written once at
+-- ingest. Dedup in the bot and in materialize_products becomes an index lookup.
+ALTER TABLE discord_messages ADD COLUMN IF NOT EXISTS signature VARCHAR(64);
+
+-- 6c. PRODUCT SEARCH
+-- Full-text vector over title / store / description, maintained by Postgres.
+-- /v1/feed?search= calls search_products() through PostgREST RPC: one ranked,
+-- index-backed query instead of ilike OR chains over JSON paths.
+ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', COALESCE(title, '')), 'A') ||
+    setweight(to_tsvector('simple', COALESCE(category_name, '')), 'B') ||
+    setweight(to_tsvector('simple', COALESCE(product_data->>'description', '')), 'C')
+) STORED;
+
+-- p_query: prefix tsquery built by the API ('nike:* & dunk:*'); p_text: raw search text for trigram fallback
+CREATE OR REPLACE FUNCTION search_products(
+    p_query TEXT,
+    p_text TEXT,
+    p_region TEXT DEFAULT NULL,
+    p_category TEXT DEFAULT NULL,
+    p_limit INT DEFAULT 20,
+    p_offset INT DEFAULT 0
+)
+RETURNS TABLE (
+    id BIGINT,
+    region VARCHAR,
+    category_name VARCHAR,
+    product_data JSONB,
+    signature VARCHAR,
+    scraped_at TIMESTAMPTZ,
+    rank REAL
+) AS $$
+    SELECT p.id, p.region, p.category_name, p.product_data, p.signature, p.scraped_at,
+           ts_rank_cd(p.search_vector, q.tsq) + similarity(COALESCE(p.title, ''), p_text) AS rank
+    FROM products p, (SELECT to_tsquery('simple', p_query) AS tsq) q
+    WHERE (p.search_vector @@ q.tsq OR p.title ILIKE '%' || p_text || '%')
+      AND (p_region IS NULL OR p.region = p_region)
+      AND (p_category IS NULL OR p.category_name ILIKE p_category)
+    ORDER BY rank DESC, p.scraped_at DESC, p.id DESC
+    LIMIT LEAST(p_limit, 100) OFFSET p_offset;
+$$ LANGUAGE sql STABLE;
+
+-- 6d. WORKER LEASES (Single active push worker across API replicas)
+-- A process owns a lease while it keeps renewing it before expires_at.
+-- cursor lets the next holder resume where the previous one stopped.
+CREATE TABLE IF NOT EXISTS worker_leases (
+    name VARCHAR(50) PRIMARY KEY,
+    holder VARCHAR(150) NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    cursor JSONB,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Returns TRUE if p_holder now holds (or renewed) the lease
+CREATE OR REPLACE FUNCTION acquire_worker_lease(p_name TEXT, p_holder TEXT, p_ttl_seconds INT)
+RETURNS BOOLEAN AS $$
+    WITH upsert AS (
+        INSERT INTO worker_leases (name, holder, expires_at, updated_at)
+        VALUES (p_name, p_holder, NOW() + make_interval(secs => p_ttl_seconds), NOW())
+        ON CONFLICT (name) DO UPDATE
+            SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at, updated_at = NOW()
+            WHERE worker_leases.holder = EXCLUDED.holder OR worker_leases.expires_at < NOW()
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM upsert);
+$$ LANGUAGE sql VOLATILE;
+
+-- 6e. PUSH DELIVERIES (Idempotency ledger: one notification per product per device)
+CREATE TABLE IF NOT EXISTS push_deliveries (
+    message_id BIGINT NOT NULL,
+    token TEXT NOT NULL,
+    sent_at TIMESTAMPTZ DEFAULT NOW(),
+    ticket_id TEXT,  -- Expo push ticket awaiting its receipt (NULL once checked)
+    PRIMARY KEY (message_id, token)
+);
+ALTER TABLE push_deliveries ADD COLUMN IF NOT EXISTS ticket_id TEXT;
+
 -- 7. AUTO-DISCOVERY TRIGGER
 -- This function automatically adds new countries/categories to the 'categories' table
 -- whenever a new product alert is posted by an admin.
@@ -108,10 +210,20 @@ EXECUTE FUNCTION auto_discover_category();
 -- 8. INDEXES
 CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(subscription_status, subscription_end);
+CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at);
 CREATE INDEX IF NOT EXISTS idx_telegram_links_user ON user_telegram_links(user_id);
 CREATE INDEX IF NOT EXISTS idx_telegram_links_telegram ON user_telegram_links(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_saved_deals_user ON saved_deals(user_id);
 CREATE INDEX IF NOT EXISTS idx_categories_country ON categories(country_code);
+CREATE INDEX IF NOT EXISTS idx_products_feed ON products(scraped_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_products_region_feed ON products(region, scraped_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_products_category_feed ON products(region, category_name, scraped_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_push_deliveries_sent ON push_deliveries(sent_at);
+CREATE INDEX IF NOT EXISTS idx_push_deliveries_ticket ON push_deliveries(sent_at) WHERE ticket_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_products_signature ON products(signature, scraped_at DESC);
+CREATE INDEX IF NOT EXISTS idx_discord_messages_signature ON discord_messages(signature, scraped_at DESC);
+CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN(search_vector);
+CREATE INDEX IF NOT EXISTS idx_products_title_trgm ON products USING GIN(title gin_trgm_ops);
 
 -- 7. INITIAL DATA (Optional)
 INSERT INTO categories (country_code, category_name, display_name) VALUES
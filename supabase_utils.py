@@ -8,9 +8,11 @@ import os
 import json
 import pickle
 import requests
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, TypedDict
 from dotenv import load_dotenv
 import re
+from datetime import datetime, timedelta
+from product_utils import DEFAULT_CHANNELS, build_channel_map, to_product_row, get_content_signature
 
 load_dotenv()
 
@@ -68,10 +70,11 @@ def sanitize_text(text: str, max_length: int = 2000) -> str:
 # -------------------
 # NEW: Direct HTTP API for Database Operations
 # -------------------
-def insert_discord_messages_direct(messages: List[Dict[str, Any]], debug: bool = True) -> bool:
+def insert_discord_messages_direct(messages: List[Dict[str, Any]], debug: bool = True, inserted_ids: Optional[set] = None) -> bool:
     """
     Insert messages using direct HTTP POST to Supabase REST API.
     This bypasses the Python client library which may have serialization issues.
+    If `inserted_ids` is given, the ids of messages in successful batches are added to it.
     """
     if not messages:
         return False
@@ -101,7 +104,8 @@ def insert_discord_messages_direct(messages: List[Dict[str, Any]], debug: bool =
                 "channel_id": sanitize_text(str(msg.get("channel_id", "")), 50),
                 "content": sanitize_text(msg.get("content", ""), 2000),
                 "scraped_at": str(msg.get("scraped_at", ""))[:50],
-                "raw_data": msg.get("raw_data", {})
+                "raw_data": msg.get("raw_data", {}),
+                "signature": get_content_signature(msg)
             }
             
             # Only add if valid
@@ -135,6 +139,7 @@ def insert_discord_messages_direct(messages: List[Dict[str, Any]], debug: bool =
             
             if response.status_code in [200, 201, 204]:
                 total_inserted += len(batch)
+                if inserted_ids is not None: inserted_ids.update(row["id"] for row in batch)
                 if debug:
                     print(f"   ✅ Batch {i//BATCH_SIZE + 1} uploaded ({len(batch)} msgs)")
             else:
@@ -193,14 +198,176 @@ def download_file(save_path: str, file_name: str, bucket: str = BUCKET_NAME) ->
         return None
 
 
+# -------------------
+# DISCORD MESSAGE READS (Named column projections)
+# -------------------
+class DiscordMessage(TypedDict, total=False):
+    id: int
+    channel_id: str
+    content: str
+    scraped_at: str
+    signature: Optional[str]
+    raw_data: Dict[str, Any]
+
+MESSAGE_COLUMNS = ("id", "channel_id", "content", "scraped_at", "signature")
+
+_EMBED_PATHS = ("embed.title", "embed.title_url", "embed.description", "embed.fields", "embed.author",
+                "embed.footer", "embed.links", "embed.images", "embed.image", "embed.thumbnail")
+
+# raw_data paths each consumer actually reads. Everything else (avatars, colors,
+# timestamps, content hashes...) stays in the database.
+MESSAGE_PROJECTIONS: Dict[str, tuple] = {
+    "broadcast": _EMBED_PATHS + ("author.name",),
+    "extract": _EMBED_PATHS + ("embeds", "attachments", "components"),
+}
+
+def message_select(projection: str) -> str:
+    """PostgREST select= for a named projection, e.g. 'embed_title:raw_data->embed->title'"""
+    parts = list(MESSAGE_COLUMNS)
+    for path in MESSAGE_PROJECTIONS[projection]:
+        keys = path.split(".")
+        parts.append(f"{'_'.join(keys)}:raw_data->{'->'.join(keys)}")
+    return ",".join(parts)
+
+def reshape_messages(rows: List[Dict[str, Any]], projection: str) -> List[DiscordMessage]:
+    """Fold projected JSON-path columns back into the raw_data shape the formatters expect"""
+    paths = [path.split(".") for path in MESSAGE_PROJECTIONS[projection]]
+    for row in rows:
+        raw: Dict[str, Any] = {}
+        for keys in paths:
+            # JSON nulls and missing keys both come back as None; leave them out like a missing key
+            value = row.pop("_".join(keys), None)
+            if value is None: continue
+            if len(keys) == 1: raw[keys[0]] = value
+            else: raw.setdefault(keys[0], {})[keys[1]] = value
+        row["raw_data"] = raw
+    return rows
+
+
+# -------------------
+# PRODUCT MATERIALIZATION (Ingest-time extraction for the mobile feed)
+# -------------------
+def load_local_channels() -> List[Dict]:
+    """Best-effort channel list for ingest when the caller doesn't pass one"""
+    for filename in ["data/channels_.json", "data/channels.json", "channels.json"]:
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as f: channels = json.load(f)
+                if channels: return channels
+            except: continue
+    return DEFAULT_CHANNELS
+
+
+# Same retailer/title/price seen again within this window is a repost, not a new product
+PRODUCT_DEDUP_WINDOW = timedelta(minutes=int(os.getenv("PRODUCT_DEDUP_WINDOW_MINUTES", "10")))
+
+def _parse_ts(value: str) -> Optional[datetime]:
+    try: return datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+    except Exception: return None
+
+def _recent_signatures(url: str, key: str, signatures: List[str], since: datetime) -> Dict[str, List[tuple]]:
+    """signature -> [(id, scraped_at)] for products already stored since `since` (idx_products_signature lookup)"""
+    found: Dict[str, List[tuple]] = {}
+    sig_list = ",".join(f'"{s}"' for s in signatures)
+    response = requests.get(
+        f"{url}/rest/v1/products",
+        headers={'apikey': key, 'Authorization': f'Bearer {key}'},
+        params={"select": "id,signature,scraped_at", "signature": f"in.({sig_list})", "scraped_at": f"gte.{since.isoformat()}"},
+        timeout=15
+    )
+    if response.status_code == 200:
+        for row in response.json():
+            found.setdefault(row["signature"], []).append((int(row["id"]), _parse_ts(row["scraped_at"])))
+    return found
+
+def dedup_product_rows(rows: List[Dict[str, Any]], url: str, key: str, debug: bool = True) -> List[Dict[str, Any]]:
+    """Drop rows whose signature was already stored (under another id) within PRODUCT_DEDUP_WINDOW"""
+    stamps = [ts for ts in (_parse_ts(r["scraped_at"]) for r in rows) if ts]
+    if not stamps: return rows
+    try:
+        seen = _recent_signatures(url, key, sorted({r["signature"] for r in rows if r.get("signature")}), min(stamps) - PRODUCT_DEDUP_WINDOW)
+    except Exception as e:
+        if debug: print(f"   ⚠️ Signature lookup failed, skipping dedup: {e}")
+        seen = {}
+    kept = []
+    for row in sorted(rows, key=lambda r: str(r["scraped_at"])):
+        ts, sig = _parse_ts(row["scraped_at"]), row.get("signature")
+        earlier = seen.get(sig, []) if sig and ts else []
+        if any(other_id != row["id"] and other_ts and timedelta(0) <= ts - other_ts <= PRODUCT_DEDUP_WINDOW for other_id, other_ts in earlier):
+            continue
+        if sig and ts: seen.setdefault(sig, []).append((row["id"], ts))
+        kept.append(row)
+    if debug and len(kept) < len(rows): print(f"   ⏭️ Skipped {len(rows) - len(kept)} duplicate product(s) within {PRODUCT_DEDUP_WINDOW}")
+    return kept
+
+def materialize_products(messages: List[Dict[str, Any]], channels: Optional[List[Dict]] = None, debug: bool = True) -> int:
+    """
+    Extract products from raw messages once and upsert them into the 'products' table.
+    The /v1/feed endpoint reads this table instead of re-parsing raw_data per request.
+    Returns the number of product rows written.
+    """
+    if not messages:
+        return 0
+
+    channel_map = build_channel_map(channels if channels is not None else load_local_channels())
+    rows = []
+    for msg in messages:
+        try:
+            row = to_product_row(msg, channel_map)
+            if row: rows.append(row)
+        except Exception as e:
+            if debug: print(f"   ⚠️ Skipped product for {msg.get('id')}: {e}")
+
+    if not rows:
+        return 0
+
+    url, key = get_supabase_config()
+    rows = dedup_product_rows(rows, url, key, debug=debug)
+    if not rows:
+        return 0
+    headers = {
+        'apikey': key,
+        'Authorization': f'Bearer {key}',
+        'Content-Type': 'application/json',
+        'Prefer': 'resolution=merge-duplicates, return=minimal'
+    }
+
+    try:
+        response = requests.post(
+            f"{url}/rest/v1/products",
+            headers=headers,
+            data=json.dumps(rows, ensure_ascii=True),
+            timeout=30
+        )
+        if response.status_code in [200, 201, 204]:
+            if debug: print(f"   ✅ Materialized {len(rows)} product(s)")
+            return len(rows)
+        if debug:
+            print(f"   ❌ Product materialization failed: HTTP {response.status_code}")
+            print(f"      Response: {response.text[:200]}")
+    except Exception as e:
+        if debug: print(f"   ❌ Product materialization error: {e}")
+    return 0
+
+
 # -------------------
 # Wrapper function for compatibility
 # -------------------
-def insert_discord_messages(messages: List[Dict[str, Any]], debug: bool = True) -> bool:
+def _message_id(msg: Dict[str, Any]) -> Optional[int]:
+    try: return int(msg["id"])
+    except Exception: return None
+
+def insert_discord_messages(messages: List[Dict[str, Any]], debug: bool = True, channels: Optional[List[Dict]] = None) -> bool:
     """
-    Main insert function - uses direct HTTP API
+    Main insert function - uses direct HTTP API.
+    Also materializes the feed 'products' rows for the messages whose batches were stored.
     """
-    return insert_discord_messages_direct(messages, debug)
+    inserted_ids: set = set()
+    inserted = insert_discord_messages_direct(messages, debug, inserted_ids)
+    if inserted:
+        stored = [msg for msg in messages if _message_id(msg) in inserted_ids]
+        materialize_products(stored, channels, debug)
+    return inserted
 
 
 # -------------------
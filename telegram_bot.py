@@ -12,17 +12,21 @@ import stripe
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, BotCommand, BotCommandScopeChat, BotCommandScopeDefault
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from bs4 import BeautifulSoup
 import supabase_utils
+from product_utils import get_content_signature
+from checkpoint_utils import CheckpointManager
 from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
 import hashlib
 import uuid
+import sqlite3
 
 load_dotenv()
 
@@ -37,6 +41,22 @@ CODES_FILE = "active_codes.json"
 POLL_INTERVAL = 120
 MAX_JOB_RUNTIME = 110
 POTENTIAL_USERS_FILE = "potential_users.json"
+# Telegram allows ~30 messages/s overall and ~1 message/s per chat
+FANOUT_RATE = 30
+FANOUT_CONCURRENCY = 25
+FANOUT_PER_CHAT_INTERVAL = 1.0
+FANOUT_MAX_RETRIES = 3
+BROADCAST_PREFETCH = 3  # alerts prepared ahead of the one being delivered
+CAMPAIGN_PROGRESS_INTERVAL = 5  # seconds between admin campaign progress edits
+PHOTO_FILE_ID_CACHE_SIZE = 512
+SENT_IDS_LIMIT = 5000  # newest Discord message ids remembered by the poller
+PENDING_ALERT_MAX_AGE = timedelta(hours=24)  # queued alerts older than this are no longer re-fetched
+CHECKPOINT_INTERVAL = 30  # min seconds between cursor checkpoint flushes (shutdown always flushes)
+DELIVERY_FAILURE_THRESHOLD = 3  # consecutive permanent failures before a chat is suppressed
+OUTBOX_PATH = "data/broadcast_outbox.db"
+OUTBOX_RETENTION = 86400  # seconds finished alerts stay in the outbox
+OUTBOX_DRAIN_MARGIN = 30  # no send starts later than this before MAX_JOB_RUNTIME (> one photo+text send, 12s+10s)
+OUTBOX_DRAIN_SLICE = 150  # recipients per fan-out slice; the deadline is checked between slices
 broadcast_lock = asyncio.Lock()
 job_start_time = None
 
@@ -607,6 +627,18 @@ class SubscriptionManager:
         # Persistence & Sync
         self.last_sync_time = 0
         self.sync_interval = 60 # Sync every 60s
+        self._state_dirty = False  # local changes waiting for flush_dirty_state()
+        
+        # Recipient index (see _index_user): who gets an alert for category/subcategory
+        self._category_index: Dict[str, set] = {}   # category -> uids with it enabled
+        self._all_categories: set = set()             # uids on the default (every category)
+        self._disabled_index: Dict[str, set] = {}   # "Category:Subcategory" -> uids that muted it
+        self._indexed: Dict[str, Tuple] = {}        # uid -> (categories, disabled subs) as indexed
+        self._expiry: Dict[str, datetime] = {}      # uid -> expiry, for unpaused users only
+        self._active: set = set()                     # unpaused and not expired
+        self._active_valid_until = datetime.max
+        # uid -> (failure kind, consecutive count); in memory so reload() doesn't reset it
+        self._delivery_failures: Dict[str, Tuple[str, int]] = {}
         
         # Stripe Config
         self.stripe_price_id_monthly = os.getenv("STRIPE_PRICE_ID_MONTHLY")
@@ -621,6 +653,9 @@ class SubscriptionManager:
         now = time.time()
         if not force and (now - self.last_sync_time) < self.sync_interval:
             return
+        # Unflushed local changes (e.g. delivery suppression) must not be overwritten by the remote copy
+        if self._state_dirty:
+            return
             
         logger.info("🔄 Reloading user state from Supabase...")
         self._load_state()
@@ -677,6 +712,105 @@ class SubscriptionManager:
                     self.potential_users = json.load(f)
             except: pass
 
+        with self.lock:
+            self._rebuild_index()
+
+    # --- Recipient index ---
+    # Maintained on every subscription/pause/expiry change so that resolving the
+    # audience of an alert is a set expression instead of a per-user check.
+
+    def _rebuild_index(self):
+        """Rebuild the whole recipient index (caller holds self.lock)"""
+        self._category_index, self._all_categories, self._disabled_index = {}, set(), {}
+        self._indexed, self._expiry, self._active = {}, {}, set()
+        self._active_valid_until = datetime.max
+        for uid in list(self.users.keys()): self._index_user(uid)
+
+    def _unindex_user(self, uid: str):
+        cats, disabled = self._indexed.pop(uid, (None, ()))
+        if cats is None: self._all_categories.discard(uid)
+        else:
+            for cat in cats: self._category_index.get(cat, set()).discard(uid)
+        for key in disabled: self._disabled_index.get(key, set()).discard(uid)
+        self._expiry.pop(uid, None)
+        self._active.discard(uid)
+
+    def _index_user(self, user_id: str):
+        """(Re)index one user after their record changed (caller holds self.lock)"""
+        uid = str(user_id)
+        self._unindex_user(uid)
+        data = self.users.get(uid)
+        if not data: return
+        cats = data.get("subscribed_categories")
+        disabled = tuple(data.get("disabled_subcategories", []))
+        if cats is None: self._all_categories.add(uid)
+        else:
+            cats = tuple(cats)
+            for cat in cats: self._category_index.setdefault(cat, set()).add(uid)
+        for key in disabled: self._disabled_index.setdefault(key, set()).add(uid)
+        self._indexed[uid] = (cats, disabled)
+        if data.get("alerts_paused", False) or data.get("delivery_suppressed"): return
+        try: expiry = parse_iso_datetime(data["expiry"])
+        except: return
+        self._expiry[uid] = expiry
+        if expiry > datetime.utcnow():
+            self._active.add(uid)
+            self._active_valid_until = min(self._active_valid_until, expiry)
+
+    def _refresh_active(self):
+        """Drop users whose subscription ran out since the active set was computed"""
+        now = datetime.utcnow()
+        if now < self._active_valid_until: return
+        self._active = {uid for uid, expiry in self._expiry.items() if expiry > now}
+        self._active_valid_until = min((self._expiry[uid] for uid in self._active), default=datetime.max)
+
+    def get_recipients(self, category: str, subcategory: str) -> set:
+        """Active users subscribed to category and not muting category:subcategory"""
+        self.reload()
+        # Users on the default follow every known category (same rule as is_subscribed)
+        default_users = self._all_categories if category in cm.get_categories() else set()
+        with self.lock:
+            self._refresh_active()
+            subscribed = self._category_index.get(category, set()) | default_users
+            return (self._active & subscribed) - self._disabled_index.get(f"{category}:{subcategory}", set())
+
+    # --- Delivery health ---
+    # Chats that keep failing permanently (blocked, deleted, invalid id) are suppressed:
+    # _index_user keeps them out of the active set until the user sends /start again.
+
+    def record_delivery_success(self, user_id: str):
+        self._delivery_failures.pop(str(user_id), None)
+
+    def record_delivery_failure(self, user_id: str, kind: str) -> bool:
+        """Count a permanent failure; returns True when this one suppressed the chat"""
+        uid = str(user_id)
+        last_kind, count = self._delivery_failures.get(uid, (kind, 0))
+        count = count + 1 if last_kind == kind else 1
+        self._delivery_failures[uid] = (kind, count)
+        if count < DELIVERY_FAILURE_THRESHOLD: return False
+        with self.lock:
+            if uid not in self.users or self.users[uid].get("delivery_suppressed"): return False
+            self.users[uid]["delivery_suppressed"] = {"reason": kind, "at": datetime.utcnow().isoformat()}
+            self._index_user(uid)
+            self._state_dirty = True
+        self._delivery_failures.pop(uid, None)
+        logger.warning(f"   🔇 {uid}: suppressed after {count} '{kind}' failures")
+        return True
+
+    def is_suppressed(self, user_id: str) -> bool:
+        return bool(self.users.get(str(user_id), {}).get("delivery_suppressed"))
+
+    def clear_delivery_suppression(self, user_id: str) -> bool:
+        """Re-enable a suppressed chat (the user reached us again); returns True if it was suppressed"""
+        uid = str(user_id)
+        self._delivery_failures.pop(uid, None)
+        with self.lock:
+            if not self.users.get(uid, {}).pop("delivery_suppressed", None): return False
+            self._index_user(uid)
+            self._state_dirty = True
+        logger.info(f"🔔 {uid}: delivery re-enabled")
+        return True
+
     def get_user_categories(self, user_id: str) -> List[str]:
         """Get enabled categories for a user (default to all if not set)"""
         uid = str(user_id)
@@ -730,6 +864,7 @@ class SubscriptionManager:
                 new_state = True
             
             self.users[uid]["subscribed_categories"] = current_cats
+            self._index_user(uid)
             self._sync_state()
             return new_state
 
@@ -753,19 +888,40 @@ class SubscriptionManager:
                 new_state = False # Now disabled
                 
             self.users[uid]["disabled_subcategories"] = disabled_subs
+            self._index_user(uid)
             self._sync_state()
             return new_state
 
-    def _sync_state(self):
+    def _state_snapshot(self) -> List[Tuple[str, str, str]]:
+        return [
+            (self.local_users_path, self.remote_users_path, json.dumps(self.users)),
+            (self.local_codes_path, self.remote_codes_path, json.dumps(self.codes)),
+            (self.local_potential_path, self.remote_potential_path, json.dumps(self.potential_users)),
+        ]
+
+    def _write_state(self, snapshot: List[Tuple[str, str, str]]) -> bool:
         try:
-            with open(self.local_users_path, 'w') as f: json.dump(self.users, f)
-            supabase_utils.upload_file(self.local_users_path, SUPABASE_BUCKET, self.remote_users_path, debug=False)
-            with open(self.local_codes_path, 'w') as f: json.dump(self.codes, f)
-            supabase_utils.upload_file(self.local_codes_path, SUPABASE_BUCKET, self.remote_codes_path, debug=False)
-            with open(self.local_potential_path, 'w') as f: json.dump(self.potential_users, f)
-            supabase_utils.upload_file(self.local_potential_path, SUPABASE_BUCKET, self.remote_potential_path, debug=False)
+            ok = True
+            for local_path, remote_path, data in snapshot:
+                with open(local_path, 'w') as f: f.write(data)
+                ok = supabase_utils.upload_file(local_path, SUPABASE_BUCKET, remote_path, debug=False) and ok
+            return ok
         except Exception as e:
             logger.error(f"Sync error: {e}")
+            return False
+
+    def _sync_state(self):
+        self._state_dirty = False
+        self._write_state(self._state_snapshot())
+
+    async def flush_dirty_state(self):
+        """Write out changes marked dirty (snapshot on the loop, file writes/uploads in sync_executor)"""
+        if not self._state_dirty: return
+        with self.lock:
+            self._state_dirty = False
+            snapshot = self._state_snapshot()
+        if not await asyncio.get_running_loop().run_in_executor(sync_executor, self._write_state, snapshot):
+            self._state_dirty = True  # retried on the next flush
 
     def generate_code(self, days: int) -> str:
         import secrets
@@ -799,6 +955,7 @@ class SubscriptionManager:
                 user_data["joined_at"] = datetime.utcnow().isoformat()
             
             self.users[str(user_id)] = user_data
+            self._index_user(user_id)
             if str(user_id) in self.potential_users:
                 self.potential_users.pop(str(user_id))
             self._sync_state()
@@ -856,6 +1013,7 @@ class SubscriptionManager:
 
                     new_expiry = base_date + timedelta(days=days_to_add)
                     self.users[uid]["expiry"] = new_expiry.isoformat()
+                    self._index_user(uid)
                     
                     if uid in self.potential_users:
                         self.potential_users.pop(uid)
@@ -898,6 +1056,7 @@ Your payment was successful and your subscription is now <b>Active</b> for the n
                         if udata.get('stripe_customer_id') == customer_id:
                             new_expiry = datetime.utcnow() + timedelta(days=days_to_add)
                             self.users[uid]["expiry"] = new_expiry.isoformat()
+                            self._index_user(uid)
                             self._sync_state()
                             logger.info(f"✅ Stripe: User {uid} subscription renewed ({days_to_add} days).")
                             
@@ -919,22 +1078,16 @@ Your payment was successful and your subscription is now <b>Active</b> for the n
                             # Immediate expiry or let it run out? 
                             # Stripe usually sends this when it FINALLY ends.
                             self.users[uid]["expiry"] = datetime.utcnow().isoformat()
+                            self._index_user(uid)
                             self._sync_state()
                             logger.info(f"❌ Stripe: User {uid} subscription terminated.")
                             break
 
     def get_active_users(self) -> List[str]:
         self.reload()
-        active = []
-        now = datetime.utcnow()
         with self.lock:
-            for uid, data in self.users.items():
-                try:
-                    if parse_iso_datetime(data["expiry"]) > now:
-                        if not data.get("alerts_paused", False):
-                            active.append(uid)
-                except: pass
-        return active
+            self._refresh_active()
+            return list(self._active)
     
     def get_all_users(self) -> List[str]:
         """Get all known users (subscribed + potential)"""
@@ -982,6 +1135,7 @@ Your payment was successful and your subscription is now <b>Active</b> for the n
                 return False
             current = self.users[str(user_id)].get("alerts_paused", False)
             self.users[str(user_id)]["alerts_paused"] = not current
+            self._index_user(user_id)
             self._sync_state()
             return not current
     
@@ -1113,16 +1267,49 @@ Your payment was successful and your subscription is now <b>Active</b> for the n
 
 # --- MESSAGE POLLER ---
 
+class BoundedRecentSet:
+    """
+    Insertion-ordered set holding at most `maxlen` items: O(1) add/membership,
+    and the oldest item is evicted first. Iterates oldest -> newest.
+    """
+    def __init__(self, maxlen: int, items=()):
+        self.maxlen = maxlen
+        self._items: OrderedDict = OrderedDict()
+        for item in items: self.add(item)
+
+    def add(self, item):
+        self._items[item] = None
+        self._items.move_to_end(item)
+        if len(self._items) > self.maxlen: self._items.popitem(last=False)
+
+    def __contains__(self, item) -> bool:
+        return item in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
 class MessagePoller:
     def __init__(self):
         self.last_scraped_at = None
-        self.sent_ids = set()
+        self.sent_ids = BoundedRecentSet(SENT_IDS_LIMIT)
+        self.pending_ids: Dict[str, str] = {}  # queued but unfinished alert ids -> scraped_at
         self.recent_signatures = []  # Last 3 sent content signatures
         self.supabase_url, self.supabase_key = supabase_utils.get_supabase_config()
         self.cursor_file = "bot_cursor.json"
         self.local_path = f"data/{self.cursor_file}"
         self.remote_path = f"discord_josh/{self.cursor_file}"
         self.time_based_signatures = {}  # {sig_hash: timestamp_iso}
+        self.checkpoint = CheckpointManager(
+            self.local_path,
+            self._cursor_state,
+            lambda path: supabase_utils.upload_file(path, SUPABASE_BUCKET, self.remote_path, debug=False),
+            CHECKPOINT_INTERVAL,
+            sync_executor
+        )
         self._init_cursor()
 
     def _init_cursor(self):
@@ -1132,7 +1319,8 @@ class MessagePoller:
                 loaded = json.loads(data)
                 self.last_scraped_at = loaded.get("last_scraped_at")
                 # Support migration from sent_hashes to sent_ids
-                self.sent_ids = set(loaded.get("sent_ids", loaded.get("sent_hashes", [])))
+                self.sent_ids = BoundedRecentSet(SENT_IDS_LIMIT, loaded.get("sent_ids", loaded.get("sent_hashes", [])))
+                self.pending_ids = loaded.get("pending_ids", {})
                 # Load persistent signatures
                 self.recent_signatures = loaded.get("recent_signatures", [])
                 # Load time-based signatures
@@ -1142,76 +1330,18 @@ class MessagePoller:
         except:
             self.last_scraped_at = (datetime.utcnow() - timedelta(hours=24)).isoformat()
 
-    def _save_cursor(self):
-        try:
-            with open(self.local_path, 'w') as f: 
-                json.dump({
-                    "last_scraped_at": self.last_scraped_at,
-                    "sent_ids": list(self.sent_ids)[-5000:],  # Increased to 5000 IDs
-                    "recent_signatures": self.recent_signatures[-20:], # Increased to last 20
-                    "time_based_signatures": self.time_based_signatures
-                }, f)
-            supabase_utils.upload_file(self.local_path, SUPABASE_BUCKET, self.remote_path, debug=False)
-        except: pass
+    def _cursor_state(self) -> Dict:
+        return {
+            "last_scraped_at": self.last_scraped_at,
+            "sent_ids": list(self.sent_ids),  # newest SENT_IDS_LIMIT ids, oldest first
+            "pending_ids": dict(self.pending_ids),
+            "recent_signatures": self.recent_signatures[-20:], # Increased to last 20
+            "time_based_signatures": dict(self.time_based_signatures)
+        }
 
-    def _get_content_signature(self, msg: Dict) -> str:
-        """Generate a signature for content-based deduplication (Retailer + Title + Price)"""
-        try:
-            raw = msg.get("raw_data", {})
-            embed = raw.get("embed") or {}
-            content = msg.get("content", "")
-            
-            retailer = ""
-            title = ""
-            price = ""
-            
-            # 1. Try Embed extraction
-            if embed.get("author"):
-                retailer = embed["author"].get("name", "")
-            
-            title = embed.get("title", "")
-            
-            # Extract price from embed fields
-            for field in embed.get("fields", []):
-                name = (field.get("name") or "").lower()
-                if "price" in name:
-                    price = field.get("value", "")
-                    break
-            
-            # 2. FALLBACK: Parse plain text content if embed data missing
-            if not retailer or not title or not price:
-                # Pattern: "@Mention | Product Name | Retailer | Just restocked for £XX.XX"
-                if content and "|" in content:
-                    parts = [p.strip() for p in content.split("|")]
-                    if len(parts) >= 3:
-                        # parts[0] is usually @Mention, but sometimes it's the product
-                        # We'll use the logic that if we still need title/retailer, we try to grab them
-                        if not title and len(parts) > 1:
-                            title = parts[1]
-                        if not retailer and len(parts) > 2:
-                            retailer = parts[2]
-                        if not price:
-                            # Extract price from any part that matches a currency pattern
-                            # Search the whole content for the most likely price
-                            price_match = re.search(r'[£$€]\s*[\d,]+\.?\d*', content)
-                            if price_match:
-                                price = price_match.group(0)
-                
-            # Final fallback for Argos or other specific keywords if still empty
-            if not retailer and "Argos" in content:
-                retailer = "Argos Instore"
-            
-            # Create raw signature and hash it
-            raw_sig = f"{retailer}|{title}|{price}".lower().strip()
-            
-            # If everything is still empty, use content hash or ID
-            if raw_sig == "||":
-                return hashlib.md5(content.encode()).hexdigest() if content else str(msg.get("id"))
-                
-            return hashlib.md5(raw_sig.encode()).hexdigest()
-        except Exception as e:
-            logger.error(f"Error generating signature: {e}")
-            return str(msg.get("id"))
+    def _save_cursor(self):
+        """Mark the cursor for the next checkpoint flush (no I/O here)"""
+        self.checkpoint.mark_dirty()
 
     def poll_new_messages(self):
         try:
@@ -1220,12 +1350,17 @@ class MessagePoller:
             
             headers = {"apikey": self.supabase_key, "Authorization": f"Bearer {self.supabase_key}"}
             url = f"{self.supabase_url}/rest/v1/discord_messages"
-            params = {"scraped_at": f"gt.{self.last_scraped_at}", "order": "scraped_at.asc"}
+            params = {"select": supabase_utils.message_select("broadcast"), "scraped_at": f"gt.{self.last_scraped_at}", "order": "scraped_at.asc"}
+            self._expire_pending()
+            if self.pending_ids:
+                # Alerts queued but not yet delivered are fetched again, so a lost outbox is rebuilt from here
+                del params["scraped_at"]
+                params["or"] = f'(scraped_at.gt."{self.last_scraped_at}",id.in.({",".join(self.pending_ids)}))'
             
             res = requests.get(url, headers=headers, params=params, timeout=45)
             if res.status_code != 200: return []
             
-            messages = res.json()
+            messages = supabase_utils.reshape_messages(res.json(), "broadcast")
             now_iso = datetime.utcnow().isoformat()
             now_dt = datetime.utcnow()
             
@@ -1239,11 +1374,16 @@ class MessagePoller:
             new_messages = []
             for msg in messages:
                 msg_id = msg.get("id")
+                # Already accepted and queued: re-queueing is a no-op unless the outbox was lost
+                if str(msg_id) in self.pending_ids:
+                    new_messages.append(msg)
+                    continue
                 # LAYER 1: Discord ID Check (All-time tracking)
                 if not msg_id or str(msg_id) in self.sent_ids:
                     continue
                 
-                sig = self._get_content_signature(msg)
+                # Signature is stored at ingest; legacy rows without one are hashed on the fly
+                sig = get_content_signature(msg)
                 
                 # LAYER 2: Content Signature (Sliding Window - last 20)
                 if sig in self.recent_signatures:
@@ -1278,6 +1418,22 @@ class MessagePoller:
         self.last_scraped_at = scraped_at
         self._save_cursor()
 
+    def track_pending(self, msgs: List[Dict]):
+        """Remember queued alerts in the cursor until the outbox finishes them"""
+        for msg in msgs: self.pending_ids[str(msg.get("id"))] = msg.get("scraped_at") or datetime.utcnow().isoformat()
+        self._save_cursor()
+
+    def release_pending(self, msg_id: str):
+        if self.pending_ids.pop(str(msg_id), None) is not None: self._save_cursor()
+
+    def _expire_pending(self):
+        cutoff = datetime.utcnow() - PENDING_ALERT_MAX_AGE
+        expired = [mid for mid, ts in self.pending_ids.items() if parse_iso_datetime(ts).replace(tzinfo=None) < cutoff]  # scraped_at is UTC
+        for mid in expired: del self.pending_ids[mid]
+        if expired:
+            logger.warning(f"⚠️ Dropped {len(expired)} undelivered alert(s) older than {PENDING_ALERT_MAX_AGE}")
+            self._save_cursor()
+
 
 
 # --- CHANNEL MANAGER ---
@@ -1704,9 +1860,10 @@ def _format_restocks_currys(msg_data: Dict, embed: Dict) -> Tuple[List[str], Lis
 # Utility functions consolidated at the top of the file
 
 
-def format_telegram_message(msg_data: Dict) -> Tuple[str, Optional[str], Optional[InlineKeyboardMarkup], bool]:
+def _format_alert(msg_data: Dict) -> Tuple[str, Optional[InlineKeyboardMarkup], Optional[str], Optional[str]]:
     """
     Dispatcher for channel-specific formatting with Fallback to Generic.
+    Pure formatting: returns (text, keyboard, discord_image_candidate, scrape_url) without touching the network.
     """
     raw = msg_data.get("raw_data", {})
     embed = raw.get("embed")
@@ -1906,75 +2063,21 @@ def format_telegram_message(msg_data: Dict) -> Tuple[str, Optional[str], Optiona
             else:
                 add_category(other_links)
 
-    # === IMAGE STRATEGY ===
-    # Strategy: "Trusted Resolution" vs "Scrape"
-    # 1. Get Discord Embed Image and Optimize it.
-    # 2. If it's a "Trusted Retailer" (Amazon/eBay) where we KNOW we fixed the resolution -> Use it (Fast).
-    # 3. If it's an unknown site (potential low res or logo) -> Scrape Website.
-    # 4. Fallback -> Use Discord Image.
-
-    image_url = None
-    image_bytes = None
-    
-    # 1. Get Best Candidate from Discord
+    # === IMAGE CANDIDATES ===
+    # Only pick the candidates here; downloading/verifying them is network I/O and
+    # happens in resolve_alert_image (off the event loop for the async path).
     discord_candidate = None
     if embed:
         if embed.get("images"):
             discord_candidate = optimize_image_url(embed["images"][0])
         elif embed.get("thumbnail"):
             discord_candidate = optimize_image_url(embed["thumbnail"])
-            
-    # 2. Empirical Check: Download and Verify Pixels
-    if discord_candidate:
-        logger.info(f"   🔍 Verifying Discord candidate image: {discord_candidate[:60]}...")
-        # Note: download_image_high_quality uses Pillow internally to verify
-        downloaded = download_image_high_quality(discord_candidate)
-        
-        if downloaded:
-            try:
-                img = Image.open(BytesIO(downloaded))
-                width, height = img.size
-                
-                # Trust it if it's high res (>= 400px in either dimension)
-                # This covers long thin images or wide banners correctly
-                if width >= 200 or height >= 200:
-                    image_url = discord_candidate
-                    image_bytes = downloaded
-                    logger.info(f"   📸 ✅ Discord image is High-Res pixels ({width}x{height}). Skipping scrape.")
-                else:
-                    logger.info(f"   ⚠️ Discord image is Low-Res pixels ({width}x{height}).")
-            except Exception as e:
-                logger.warning(f"   ⚠️ Failed to verify Discord image pixels: {e}")
 
-    # 3. Attempt Scraping ONLY if we don't have a high-res candidate yet
-    if not image_url:
-        target_scrape_url = None
-        if title_links: target_scrape_url = title_links[0]['url']
-        elif buy_links: target_scrape_url = buy_links[0]['url']
-        elif atc_links: target_scrape_url = atc_links[0]['url']
-        elif other_links: target_scrape_url = other_links[0]['url']
-        
-        if target_scrape_url:
-            skip_scrape = any(x in target_scrape_url.lower() for x in ['keepa.com', 'ebay.com/sch', 'login', 'cart', 'checkout'])
-            if not skip_scrape:
-                logger.info(f"   🔍 Attempting to scrape images from: {target_scrape_url[:60]}...")
-                scraped_images = fetch_product_images(target_scrape_url, max_images=1)
-                if scraped_images:
-                    scraped_url = scraped_images[0]
-                    # Verify scraped image quality as well
-                    logger.info(f"   🔍 Verifying scraped image: {scraped_url[:60]}...")
-                    downloaded_scraped = download_image_high_quality(scraped_url)
-                    if downloaded_scraped:
-                        image_url = scraped_url
-                        image_bytes = downloaded_scraped
-                        logger.info(f"   📸 ✅ Using verified scraped website image.")
-
-    # 4. Final Fallback (If scraping failed or returned low res, use the best we found)
-    if not image_url and discord_candidate:
-        image_url = discord_candidate
-        # We might already have the bytes from step 2
-        # Use them if available, otherwise just use the URL
-        logger.info(f"   📸 Fallback to Discord image.")
+    scrape_url = None
+    if title_links: scrape_url = title_links[0]['url']
+    elif buy_links: scrape_url = buy_links[0]['url']
+    elif atc_links: scrape_url = atc_links[0]['url']
+    elif other_links: scrape_url = other_links[0]['url']
     
     # === BUTTON CREATION ===
     keyboard = []
@@ -2035,7 +2138,78 @@ def format_telegram_message(msg_data: Dict) -> Tuple[str, Optional[str], Optiona
     if custom_buttons:
         keyboard.extend(custom_buttons)
     
-    return text, image_url, InlineKeyboardMarkup(keyboard) if keyboard else None, image_bytes
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None, discord_candidate, scrape_url
+
+
+def resolve_alert_image(discord_candidate: Optional[str], scrape_url: Optional[str]) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Pick the alert photo (blocking: downloads and scrapes). Returns (image_url, image_bytes).
+    Strategy: verified high-res Discord image -> scraped product-page image -> Discord image URL fallback.
+    """
+    image_url = None
+    image_bytes = None
+    
+    # 1. Empirical Check: Download and Verify Pixels
+    if discord_candidate:
+        logger.info(f"   🔍 Verifying Discord candidate image: {discord_candidate[:60]}...")
+        # Note: download_image_high_quality uses Pillow internally to verify
+        downloaded = download_image_high_quality(discord_candidate)
+        
+        if downloaded:
+            try:
+                img = Image.open(BytesIO(downloaded))
+                width, height = img.size
+                
+                # Trust it if it's high res (>= 400px in either dimension)
+                # This covers long thin images or wide banners correctly
+                if width >= 200 or height >= 200:
+                    image_url = discord_candidate
+                    image_bytes = downloaded
+                    logger.info(f"   📸 ✅ Discord image is High-Res pixels ({width}x{height}). Skipping scrape.")
+                else:
+                    logger.info(f"   ⚠️ Discord image is Low-Res pixels ({width}x{height}).")
+            except Exception as e:
+                logger.warning(f"   ⚠️ Failed to verify Discord image pixels: {e}")
+
+    # 2. Attempt Scraping ONLY if we don't have a high-res candidate yet
+    if not image_url and scrape_url:
+        skip_scrape = any(x in scrape_url.lower() for x in ['keepa.com', 'ebay.com/sch', 'login', 'cart', 'checkout'])
+        if not skip_scrape:
+            logger.info(f"   🔍 Attempting to scrape images from: {scrape_url[:60]}...")
+            scraped_images = fetch_product_images(scrape_url, max_images=1)
+            if scraped_images:
+                scraped_url = scraped_images[0]
+                # Verify scraped image quality as well
+                logger.info(f"   🔍 Verifying scraped image: {scraped_url[:60]}...")
+                downloaded_scraped = download_image_high_quality(scraped_url)
+                if downloaded_scraped:
+                    image_url = scraped_url
+                    image_bytes = downloaded_scraped
+                    logger.info(f"   📸 ✅ Using verified scraped website image.")
+
+    # 3. Final Fallback (If scraping failed or returned low res, use the Discord URL as-is)
+    if not image_url and discord_candidate:
+        image_url = discord_candidate
+        logger.info(f"   📸 Fallback to Discord image.")
+    
+    return image_url, image_bytes
+
+
+def format_telegram_message(msg_data: Dict) -> Tuple[str, Optional[str], Optional[InlineKeyboardMarkup], Optional[bytes]]:
+    """Blocking formatter (scripts/diagnostics). Bot handlers must use format_telegram_message_async."""
+    text, keyboard, discord_candidate, scrape_url = _format_alert(msg_data)
+    image_url, image_bytes = resolve_alert_image(discord_candidate, scrape_url)
+    return text, image_url, keyboard, image_bytes
+
+
+async def format_telegram_message_async(msg_data: Dict) -> Tuple[str, Optional[str], Optional[InlineKeyboardMarkup], Optional[bytes]]:
+    """Format on the loop (pure CPU) and await image download/scrape in sync_executor so no handler stalls on it."""
+    text, keyboard, discord_candidate, scrape_url = _format_alert(msg_data)
+    image_url, image_bytes = None, None
+    if discord_candidate or scrape_url:
+        loop = asyncio.get_running_loop()
+        image_url, image_bytes = await loop.run_in_executor(sync_executor, resolve_alert_image, discord_candidate, scrape_url)
+    return text, image_url, keyboard, image_bytes
 
 
 
@@ -2177,7 +2351,7 @@ async def test_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         headers = {"apikey": poller.supabase_key, "Authorization": f"Bearer {poller.supabase_key}"}
         url = f"{poller.supabase_url}/rest/v1/discord_messages"
         params = {
-            "select": "*",
+            "select": supabase_utils.message_select("broadcast"),
             "order": "scraped_at.desc",
             "limit": count
         }
@@ -2187,7 +2361,7 @@ async def test_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ API Error: {res.status_code}")
             return
             
-        messages = res.json()
+        messages = supabase_utils.reshape_messages(res.json(), "broadcast")
         if not messages:
             await update.message.reply_text("⚠️ No messages found in DB.")
             return
@@ -2213,13 +2387,13 @@ async def test_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.debug(f"   ⏭️ Skipping test alert for {user_id}: {msg_category}/{msg_subcategory} unsubscribed")
                 continue
 
-            text, image_url, keyboard, image_bytes = format_telegram_message(msg)
+            text, image_url, keyboard, image_bytes = await format_telegram_message_async(msg)
             
             # Prepare photo data once
             photo_data = image_url
             if image_bytes:
                 # Reuse pre-verified bytes from formatting step
-                photo_data = BytesIO(image_bytes)
+                photo_data = image_bytes
                 logger.info(f"   ✅ Using pre-verified image bytes ({len(image_bytes)} bytes)")
             elif image_url:
                 try:
@@ -2227,20 +2401,18 @@ async def test_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     loop = asyncio.get_event_loop()
                     downloaded = await loop.run_in_executor(sync_executor, download_image_high_quality, image_url)
                     if downloaded:
-                        photo_data = BytesIO(downloaded)
+                        photo_data = downloaded
                         logger.info(f"   ✅ Processed image via Pillow fallback ({len(downloaded)} bytes)")
                 except Exception as e:
                     logger.warning(f"   ⚠️ Pillow processing failed, falling back to URL: {e}")
 
-            # Send (Admin only)
+            # Send (Admin only) - replays reuse the file_id from the live broadcast when there was one
             if photo_data:
                 try:
-                    # If it's BytesIO, seek(0) to be safe for multiple users (though not needed here)
-                    if isinstance(photo_data, BytesIO): photo_data.seek(0)
-                    
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo_data,
+                    await send_photo_cached(
+                        context.bot,
+                        user_id,
+                        photo_data,
                         caption=text,
                         parse_mode=ParseMode.HTML,
                         reply_markup=keyboard
@@ -2609,6 +2781,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or update.effective_user.first_name
     
+    # The user reached us again, so a chat suppressed for failed deliveries can receive alerts
+    if sm.clear_delivery_suppression(user_id): await sm.flush_dirty_state()
+    
     # Check for deep link parameter (from app)
     if context.args and len(context.args) > 0:
         param = context.args[0]
@@ -3029,6 +3204,261 @@ async def list_channels_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
+# --- FAN-OUT ENGINE ---
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while (global flood-wait from Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        # Refill starts when the pause ends, not from the last send: no full burst right after a flood-wait
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FanoutEngine:
+    """
+    Sends one payload to many chats with bounded concurrency, a global token
+    bucket sized to Telegram's broadcast limit and per-chat spacing.
+    RetryAfter pauses the whole bucket and the send is retried.
+    Low-priority runs (admin campaigns) only take tokens while no alert run is active.
+    """
+    def __init__(self, rate: float, concurrency: int, per_chat_interval: float):
+        self.bucket = TokenBucket(rate, rate)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.chat_next_at: Dict[str, float] = {}
+        self.alert_runs = 0
+        self.alerts_idle = asyncio.Event()
+        self.alerts_idle.set()
+
+    async def _wait_for_chat(self, chat_id: str):
+        now = time.monotonic()
+        slot = max(now, self.chat_next_at.get(chat_id, 0.0))
+        self.chat_next_at[chat_id] = slot + self.per_chat_interval
+        if slot > now: await asyncio.sleep(slot - now)
+
+    async def send(self, chat_id: str, send_fn, low_priority: bool = False):
+        """Run `send_fn()` for one chat under the rate limits; RetryAfter is retried"""
+        for attempt in range(FANOUT_MAX_RETRIES + 1):
+            if low_priority: await self.alerts_idle.wait()
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                return await send_fn()
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logger.warning(f"   ⏳ Flood control: retry after {retry_after:.0f}s (chat {chat_id}, attempt {attempt + 1})")
+                self.bucket.pause(retry_after)
+                if attempt == FANOUT_MAX_RETRIES: raise
+
+    async def run(self, chat_ids: List[str], make_send, low_priority: bool = False) -> List:
+        """Fan `make_send(chat_id)` out to every chat; returns results/exceptions in chat order"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _one(chat_id):
+            async with semaphore:
+                return await self.send(chat_id, lambda: make_send(chat_id), low_priority)
+
+        if not low_priority:
+            self.alert_runs += 1
+            self.alerts_idle.clear()
+        try:
+            results = await asyncio.gather(*[_one(uid) for uid in chat_ids], return_exceptions=True)
+        finally:
+            if not low_priority:
+                self.alert_runs -= 1
+                if not self.alert_runs: self.alerts_idle.set()
+        # Forget per-chat slots that are already in the past
+        now = time.monotonic()
+        self.chat_next_at = {c: t for c, t in self.chat_next_at.items() if t > now}
+        return results
+
+
+fanout = FanoutEngine(FANOUT_RATE, FANOUT_CONCURRENCY, FANOUT_PER_CHAT_INTERVAL)
+
+
+# --- PHOTO FILE_ID CACHE ---
+
+class PhotoFileIdCache:
+    """
+    Image hash -> Telegram file_id (LRU). After the first upload of an image,
+    every later send references the stored file instead of re-uploading bytes.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def key_for(photo_data) -> Optional[str]:
+        if isinstance(photo_data, bytes): return hashlib.sha1(photo_data).hexdigest()
+        if isinstance(photo_data, str) and photo_data: return "url:" + hashlib.sha1(photo_data.encode()).hexdigest()
+        return None
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if not key or key not in self.entries: return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: str, file_id: str):
+        self.entries[key] = file_id
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def evict(self, key: str):
+        self.entries.pop(key, None)
+
+
+photo_file_ids = PhotoFileIdCache(PHOTO_FILE_ID_CACHE_SIZE)
+
+
+async def send_photo_cached(bot, chat_id, photo_data, **kwargs):
+    """send_photo that reuses a cached file_id for this image, or uploads it once and remembers the file_id"""
+    key = photo_file_ids.key_for(photo_data)
+    file_id = photo_file_ids.get(key)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if "file" not in str(e).lower(): raise
+            # Telegram no longer accepts this file_id: forget it and upload again
+            logger.warning(f"   ♻️ Cached file_id rejected ({e}); re-uploading")
+            photo_file_ids.evict(key)
+    photo = BytesIO(photo_data) if isinstance(photo_data, bytes) else photo_data
+    message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    if key and message and message.photo: photo_file_ids.put(key, message.photo[-1].file_id)
+    return message
+
+
+# --- BROADCAST OUTBOX ---
+
+class BroadcastOutbox:
+    """
+    Durable (alert, recipient, status) queue in SQLite. Polled alerts are stored
+    before any work; recipients are snapshotted once the alert is formatted and
+    each delivery is marked as it completes, so a timed-out, crashed or restarted
+    bot resumes at the exact recipient instead of re-sending or dropping the alert.
+    The file is local, so unfinished alert ids are also kept in the poller's cursor
+    (see finish_alert): if the disk is wiped they are polled and queued again.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox_alerts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                msg_id TEXT UNIQUE NOT NULL,
+                msg TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'new',  -- new -> ready -> done
+                text TEXT,
+                photo BLOB,
+                photo_url TEXT,
+                keyboard TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox_deliveries (
+                msg_id TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',  -- pending -> sent | failed
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (msg_id, chat_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_alerts_state ON outbox_alerts(state, seq);
+        """)
+        self.db.commit()
+
+    def add_messages(self, msgs: List[Dict]) -> int:
+        """Queue polled messages in order; already-queued ids are ignored"""
+        now = time.time()
+        with self.db:
+            cur = self.db.executemany(
+                "INSERT OR IGNORE INTO outbox_alerts (msg_id, msg, updated_at) VALUES (?, ?, ?)",
+                [(str(m.get("id")), json.dumps(m), now) for m in msgs]
+            )
+        return cur.rowcount
+
+    def unfinished(self) -> List[sqlite3.Row]:
+        return self.db.execute("SELECT * FROM outbox_alerts WHERE state != 'done' ORDER BY seq").fetchall()
+
+    def save_prepared(self, msg_id: str, text: str, photo_data, keyboard: Optional[InlineKeyboardMarkup], recipients: List[str]):
+        """Store the formatted payload and snapshot its recipients as pending deliveries"""
+        now = time.time()
+        photo = photo_data if isinstance(photo_data, bytes) else None
+        photo_url = photo_data if isinstance(photo_data, str) else None
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox_alerts SET state = 'ready', text = ?, photo = ?, photo_url = ?, keyboard = ?, updated_at = ? WHERE msg_id = ?",
+                (text, photo, photo_url, keyboard.to_json() if keyboard else None, now, msg_id)
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO outbox_deliveries (msg_id, chat_id, updated_at) VALUES (?, ?, ?)",
+                [(msg_id, str(uid), now) for uid in recipients]
+            )
+
+    @staticmethod
+    def payload(row: sqlite3.Row, bot) -> Tuple[str, object, Optional[InlineKeyboardMarkup]]:
+        keyboard = InlineKeyboardMarkup.de_json(json.loads(row["keyboard"]), bot) if row["keyboard"] else None
+        return row["text"], row["photo"] or row["photo_url"], keyboard
+
+    def pending_recipients(self, msg_id: str) -> List[str]:
+        rows = self.db.execute("SELECT chat_id FROM outbox_deliveries WHERE msg_id = ? AND status = 'pending'", (msg_id,))
+        return [r["chat_id"] for r in rows]
+
+    def mark(self, msg_id: str, chat_id: str, status: str):
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox_deliveries SET status = ?, updated_at = ? WHERE msg_id = ? AND chat_id = ?",
+                (status, time.time(), msg_id, str(chat_id))
+            )
+
+    def finish(self, msg_id: str):
+        with self.db:
+            self.db.execute("UPDATE outbox_alerts SET state = 'done', photo = NULL, updated_at = ? WHERE msg_id = ?", (time.time(), msg_id))
+
+    def prune(self, retention: float = OUTBOX_RETENTION):
+        cutoff = time.time() - retention
+        with self.db:
+            self.db.execute(
+                "DELETE FROM outbox_deliveries WHERE msg_id IN (SELECT msg_id FROM outbox_alerts WHERE state = 'done' AND updated_at < ?)",
+                (cutoff,)
+            )
+            self.db.execute("DELETE FROM outbox_alerts WHERE state = 'done' AND updated_at < ?", (cutoff,))
+
+
+outbox = BroadcastOutbox(OUTBOX_PATH)
+
+
+def finish_alert(msg_id: str):
+    """Mark an alert done in the outbox and drop it from the cursor's pending ids"""
+    outbox.finish(msg_id)
+    poller.release_pending(msg_id)
+
+
 async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
     """
     Poll for new messages and broadcast with timeout protection.
@@ -3074,6 +3504,14 @@ async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
         
         finally:
             job_start_time = None
+            # Batch boundary: persist the cursor and any suppressed chats once per cycle, even after a timeout
+            await poller.checkpoint.flush()
+            await sm.flush_dirty_state()
+
+
+async def flush_checkpoints(application: Application):
+    """post_shutdown hook: write out any cursor state not yet flushed"""
+    poller.checkpoint.flush_now()
 
 
 async def expiry_reminder_job(context: ContextTypes.DEFAULT_TYPE):
@@ -3172,9 +3610,97 @@ You recently checked out Hollowscan but haven't activated your subscription yet.
         logger.info(f"✅ Sent {sent} potential user reminder(s)")
 
 
+def classify_delivery_error(error: Exception) -> Optional[str]:
+    """Permanent failure kind for a send error, or None when it is worth retrying"""
+    error_str = str(error).lower()
+    if "bot was blocked" in error_str: return "blocked"
+    if "user is deactivated" in error_str: return "deactivated"
+    if "chat not found" in error_str or "user not found" in error_str: return "chat_not_found"
+    if "chat_id_invalid" in error_str: return "chat_id_invalid"
+    if "bot was kicked" in error_str or "not a member" in error_str: return "kicked"
+    return None
+
+
+async def _deliver_alert(bot, uid: str, text: str, photo_data, keyboard) -> bool:
+    """
+    Send one formatted alert to one chat (photo with text fallback).
+    Returns True on delivery; RetryAfter propagates so the fan-out engine can back off.
+    """
+    try:
+        # Send with timeout protection
+        if photo_data:
+            try:
+                # Uploads the image once per alert; later recipients get the cached file_id
+                await asyncio.wait_for(
+                    send_photo_cached(
+                        bot,
+                        uid,
+                        photo_data,
+                        caption=text[:1024],
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=keyboard
+                    ),
+                    timeout=12.0
+                )
+                sm.record_delivery_success(uid)
+                return True
+                
+            except RetryAfter:
+                raise
+                
+            except asyncio.TimeoutError:
+                logger.warning(f"   ⏱️  {uid}: Photo send timeout")
+                
+            except Exception as photo_error:
+                logger.error(f"   ❌ {uid}: Photo failed - {type(photo_error).__name__}")
+                
+        # Text-only (or fallback after a failed photo)
+        await asyncio.wait_for(
+            bot.send_message(
+                chat_id=uid,
+                text=text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+                disable_web_page_preview=False
+            ),
+            timeout=10.0
+        )
+        sm.record_delivery_success(uid)
+        return True
+    
+    except RetryAfter:
+        raise
+    
+    except asyncio.TimeoutError:
+        logger.warning(f"   ⏱️  {uid}: Message send timeout")
+        
+    except Exception as e:
+        error_str = str(e)
+        failure_kind = classify_delivery_error(e)
+        if failure_kind: sm.record_delivery_failure(uid, failure_kind)
+        if "user not found" in error_str.lower() or "chat_id_invalid" in error_str.lower():
+            logger.warning(f"   ⛔ {uid}: User invalid/blocked")
+        elif "bot was blocked" in error_str.lower():
+            logger.warning(f"   🚫 {uid}: Bot blocked by user")
+        elif "badrequest" in error_str.lower():
+            # Log full error for BadRequest to diagnose formatting issues
+            logger.error(f"   ❌ {uid}: BadRequest - {error_str}")
+            logger.error(f"      Message preview: {text[:200]}...")
+        else:
+            logger.error(f"   ❌ {uid}: {type(e).__name__}: {error_str}")
+    return False
+
+
 async def _broadcast_job_inner(context: ContextTypes.DEFAULT_TYPE):
     """Inner broadcast logic - separated for timeout handling"""
-    
+    # Stop starting new sends a little before wait_for cancels us, so nothing is cut off mid-send
+    deadline = time.monotonic() + MAX_JOB_RUNTIME - OUTBOX_DRAIN_MARGIN
+    await _enqueue_new_alerts(context)
+    await _drain_outbox(context, deadline)
+
+
+async def _enqueue_new_alerts(context: ContextTypes.DEFAULT_TYPE):
+    """Poll, filter and durably queue new alerts in the outbox"""
     # Poll for new messages
     try:
         new_msgs = poller.poll_new_messages()
@@ -3243,160 +3769,147 @@ async def _broadcast_job_inner(context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"   New messages waiting: {len(filtered_msgs)}")
         return
     
-    logger.info(f"📤 BROADCAST: {len(filtered_msgs)} message(s) → {len(active_users)} active user(s)")
+    # Queue before any formatting/sending. The cursor keeps the ids until they are finished,
+    # so it can move on without losing them if the local outbox goes away
+    queued = outbox.add_messages(filtered_msgs)
+    poller.track_pending(filtered_msgs)
+    logger.info(f"📥 BROADCAST: queued {queued} message(s) → {len(active_users)} active user(s)")
+    last_scraped_at = filtered_msgs[-1].get("scraped_at")
+    if last_scraped_at:
+        poller.update_cursor(last_scraped_at)
+        logger.debug(f"   📌 Cursor updated to: {last_scraped_at}")
+
+
+async def _drain_outbox(context: ContextTypes.DEFAULT_TYPE, deadline: float):
+    """Deliver every unfinished outbox alert in order, resuming each at its pending recipients"""
+    outbox.prune()
+    alerts = outbox.unfinished()
+    if not alerts: return
+    logger.info(f"📤 BROADCAST: {len(alerts)} alert(s) in outbox")
     
-    # Process messages with batching
-    for msg_idx, msg in enumerate(filtered_msgs):
-        try:
-            logger.debug(f"   🔨 Formatting message {msg_idx + 1}/{len(filtered_msgs)}...")
-            text, image_url, keyboard, image_bytes = format_telegram_message(msg)
-            logger.debug(f"   ✓ Formatted (text={len(text)} chars, image={'yes' if image_url else 'no'})")
-            
-            # Validate message is not empty
-            if not text or len(text.strip()) == 0:
-                continue
-            
-        except Exception as e:
-            logger.error(f"   ❌ Failed to format message {msg_idx + 1}: {type(e).__name__}: {e}")
-            continue
-        
-        # Prepare photo data once per message
-        photo_data = image_url
-        if image_bytes:
-            # Reuse pre-verified bytes from formatting step
-            photo_data = image_bytes
-            logger.info(f"   ✅ Using pre-verified message image bytes ({len(image_bytes)} bytes)")
-        elif image_url:
-            try:
-                # Fallback for unexpected cases
-                loop = asyncio.get_event_loop()
-                downloaded = await loop.run_in_executor(sync_executor, download_image_high_quality, image_url)
-                if downloaded:
-                    photo_data = downloaded
-                    logger.info(f"   ✅ Processed message image via Pillow fallback ({len(downloaded)} bytes)")
-            except Exception as e:
-                logger.warning(f"   ⚠️ Pillow processing failed: {e}")
-
-        # Send to all active users with rate limiting
-        sent_count = 0
-        failed_count = 0
-        
-        # Determine Category & Subcategory
-        msg_channel_id = str(msg.get("channel_id"))
-        msg_category = "Uncategorized"
-        msg_subcategory = "Unknown"
-        for c in cm.channels:
-            if c['id'] == msg_channel_id:
-                msg_category = c.get('category', 'Uncategorized')
-                msg_subcategory = c.get('name', 'Unknown')
-                break
-        
-        # Send to all active users with rate limiting
-        sent_count = 0
-        failed_count = 0
-        
-        for uid in active_users:
-            # CHECK SUBSCRIPTION
-            if not sm.is_subscribed(uid, msg_category, msg_subcategory):
-                continue
+    # Pipeline: alerts i+1..i+k are formatted and their images resolved while alert i is delivered.
+    # Delivery still happens strictly in queue order; alerts already prepared are loaded from the outbox.
+    prepared: Dict[int, asyncio.Future] = {}
 
-            try:
-                # Send with timeout protection
-                if photo_data:
-                    try:
-                        # Prepare the payload (BytesIO if we have raw bytes)
-                        current_photo = photo_data
-                        if isinstance(photo_data, bytes):
-                            current_photo = BytesIO(photo_data)
-                            
-                        await asyncio.wait_for(
-                            context.bot.send_photo(
-                                chat_id=uid,
-                                photo=current_photo,
-                                caption=text[:1024],
-                                parse_mode=ParseMode.HTML,
-                                reply_markup=keyboard
-                            ),
-                            timeout=12.0
-                        )
-                        sent_count += 1
-                        
-                    except asyncio.TimeoutError:
-                        logger.warning(f"   ⏱️  {uid}: Photo send timeout")
-                        # Fallback to text
-                        await asyncio.wait_for(
-                            context.bot.send_message(
-                                chat_id=uid,
-                                text=text,
-                                parse_mode=ParseMode.HTML,
-                                reply_markup=keyboard,
-                                disable_web_page_preview=False
-                            ),
-                            timeout=10.0
-                        )
-                        sent_count += 1
-                        
-                    except Exception as photo_error:
-                        logger.error(f"   ❌ {uid}: Photo failed - {type(photo_error).__name__}")
-                        # Fallback to text
-                        try:
-                            await asyncio.wait_for(
-                                context.bot.send_message(
-                                    chat_id=uid,
-                                    text=text,
-                                    parse_mode=ParseMode.HTML,
-                                    reply_markup=keyboard,
-                                    disable_web_page_preview=False
-                                ),
-                                timeout=10.0
-                            )
-                            sent_count += 1
-                        except:
-                            failed_count += 1
-                else:
-                    # Text-only
-                    await asyncio.wait_for(
-                        context.bot.send_message(
-                            chat_id=uid,
-                            text=text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=keyboard,
-                            disable_web_page_preview=False
-                        ),
-                        timeout=10.0
-                    )
-                    sent_count += 1
-            
-            except asyncio.TimeoutError:
-                logger.warning(f"   ⏱️  {uid}: Message send timeout")
-                failed_count += 1
-                
-            except Exception as e:
-                error_str = str(e)
-                if "user not found" in error_str.lower() or "chat_id_invalid" in error_str.lower():
-                    logger.warning(f"   ⛔ {uid}: User invalid/blocked")
-                elif "bot was blocked" in error_str.lower():
-                    logger.warning(f"   🚫 {uid}: Bot blocked by user")
-                elif "badrequest" in error_str.lower():
-                    # Log full error for BadRequest to diagnose formatting issues
-                    logger.error(f"   ❌ {uid}: BadRequest - {error_str}")
-                    logger.error(f"      Message preview: {text[:200]}...")
-                else:
-                    logger.error(f"   ❌ {uid}: {type(e).__name__}: {error_str}")
-                failed_count += 1
-            
-            # Rate limit protection - small delay between users
-            await asyncio.sleep(0.05)
+    def _schedule(idx: int):
+        if idx < len(alerts) and idx not in prepared and alerts[idx]["state"] == "new":
+            prepared[idx] = asyncio.ensure_future(_prepare_alert(json.loads(alerts[idx]["msg"]), idx, len(alerts)))
+
+    try:
+        for i in range(min(BROADCAST_PREFETCH, len(alerts))): _schedule(i)
+        for msg_idx, row in enumerate(alerts):
+            if time.monotonic() > deadline:
+                logger.warning(f"   ⏸️ Outbox drain paused: {len(alerts) - msg_idx} alert(s) left for the next cycle")
+                return
+            _schedule(msg_idx + BROADCAST_PREFETCH)
+            msg_id = row["msg_id"]
+            if row["state"] == "new":
+                try:
+                    # Image resolution can be slow: never let it run into the job's hard timeout
+                    alert = await asyncio.wait_for(prepared.pop(msg_idx), timeout=max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    logger.warning(f"   ⏸️ Outbox drain paused while preparing: {len(alerts) - msg_idx} alert(s) left for the next cycle")
+                    return
+                if not alert:
+                    finish_alert(msg_id)
+                    continue
+                text, photo_data, keyboard = alert
+                outbox.save_prepared(msg_id, text, photo_data, keyboard, _alert_recipients(json.loads(row["msg"])))
+                if time.monotonic() > deadline:
+                    logger.warning(f"   ⏸️ Outbox drain paused: {len(alerts) - msg_idx} alert(s) left for the next cycle")
+                    return
+            else:
+                text, photo_data, keyboard = outbox.payload(row, context.bot)
+            await _deliver_broadcast_message(context, msg_id, msg_idx, text, photo_data, keyboard, deadline)
+    finally:
+        # Job timeout/cancel: drop look-ahead work that hasn't started yet
+        for future in prepared.values(): future.cancel()
+
+
+async def _prepare_alert(msg: Dict, msg_idx: int, total: int) -> Optional[Tuple[str, object, Optional[InlineKeyboardMarkup]]]:
+    """Format one alert and settle its photo (image I/O awaited in sync_executor). None means skip."""
+    try:
+        logger.debug(f"   🔨 Formatting message {msg_idx + 1}/{total}...")
+        text, image_url, keyboard, image_bytes = await format_telegram_message_async(msg)
+        logger.debug(f"   ✓ Formatted (text={len(text)} chars, image={'yes' if image_url else 'no'})")
         
-        logger.info(f"   📊 Message {msg_idx + 1}: ✅ {sent_count} sent, ❌ {failed_count} failed")
+        # Validate message is not empty
+        if not text or len(text.strip()) == 0:
+            return None
         
-        # Update cursor ONLY after successful processing of this message
-        # This ensures failed messages are retried on next poll
-        if sent_count > 0:  # At least one user received it
-            msg_scraped_at = msg.get("scraped_at")
-            if msg_scraped_at:
-                poller.update_cursor(msg_scraped_at, msg)
-                logger.debug(f"   📌 Cursor updated to: {msg_scraped_at}")
+    except Exception as e:
+        logger.error(f"   ❌ Failed to format message {msg_idx + 1}: {type(e).__name__}: {e}")
+        return None
+    
+    # Prepare photo data once per message
+    photo_data = image_url
+    if image_bytes:
+        # Reuse pre-verified bytes from formatting step
+        photo_data = image_bytes
+        logger.info(f"   ✅ Using pre-verified message image bytes ({len(image_bytes)} bytes)")
+    elif image_url:
+        try:
+            # Fallback for unexpected cases
+            downloaded = await asyncio.get_running_loop().run_in_executor(sync_executor, download_image_high_quality, image_url)
+            if downloaded:
+                photo_data = downloaded
+                logger.info(f"   ✅ Processed message image via Pillow fallback ({len(downloaded)} bytes)")
+        except Exception as e:
+            logger.warning(f"   ⚠️ Pillow processing failed: {e}")
+    return text, photo_data, keyboard
+
+
+def _alert_recipients(msg: Dict) -> List[str]:
+    """Active users subscribed to the message's category/subcategory"""
+    # Determine Category & Subcategory
+    msg_channel_id = str(msg.get("channel_id"))
+    msg_category = "Uncategorized"
+    msg_subcategory = "Unknown"
+    for c in cm.channels:
+        if c['id'] == msg_channel_id:
+            msg_category = c.get('category', 'Uncategorized')
+            msg_subcategory = c.get('name', 'Unknown')
+            break
+    return list(sm.get_recipients(msg_category, msg_subcategory))
+
+
+async def _deliver_broadcast_message(context: ContextTypes.DEFAULT_TYPE, msg_id: str, msg_idx: int, text: str, photo_data, keyboard, deadline: float):
+    """Fan one prepared alert out to its pending outbox recipients, recording each delivery as it lands"""
+    recipients = outbox.pending_recipients(msg_id)
+
+    async def deliver(uid: str) -> Optional[bool]:
+        # Checked after the rate-limit wait, right before the send: past the deadline the
+        # recipient stays pending instead of being cut off mid-send by the job timeout
+        if time.monotonic() > deadline: return None
+        # Chats suppressed since the recipients were snapshotted are not tried again
+        ok = not sm.is_suppressed(uid) and await _deliver_alert(context.bot, uid, text, photo_data, keyboard)
+        outbox.mark(msg_id, uid, "sent" if ok else "failed")
+        return ok
+
+    results = []
+    photo_key = photo_file_ids.key_for(photo_data)
+    # Upload the image once: deliver one recipient at a time until Telegram hands back a file_id
+    upload_attempts = 0
+    while recipients and photo_key and not photo_file_ids.get(photo_key) and upload_attempts < 3:
+        if time.monotonic() > deadline: break
+        results += await fanout.run(recipients[:1], deliver)
+        recipients = recipients[1:]
+        upload_attempts += 1
+    # Fan out in slices so a job nearing its deadline stops between slices; the rest stay pending
+    for start in range(0, len(recipients), OUTBOX_DRAIN_SLICE):
+        if time.monotonic() > deadline: break
+        results += await fanout.run(recipients[start:start + OUTBOX_DRAIN_SLICE], deliver)
+    sent_count = sum(1 for r in results if r is True)
+    failed_count = sum(1 for r in results if r is False)
+    
+    logger.info(f"   📊 Message {msg_idx + 1}: ✅ {sent_count} sent, ❌ {failed_count} failed")
+    
+    # Flood-control give-ups and deadline leftovers stay pending and are resumed next cycle
+    pending = len(outbox.pending_recipients(msg_id))
+    if pending:
+        logger.info(f"   ⏸️ Message {msg_idx + 1}: {pending} recipient(s) still pending")
+    else:
+        finish_alert(msg_id)
 
 # 4. COMMAND MENU SETUP
 
@@ -3470,6 +3983,99 @@ async def setup_bot_commands(context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         logger.error(f"   ❌ Failed to set command menus: {e}")
 
+# --- ADMIN CAMPAIGNS ---
+
+class AdminCampaign:
+    """
+    An admin /broadcast or /unpin_all run as a background task on the shared
+    fan-out engine at low priority (it yields to product alerts), with a live
+    progress message and a cancel button.
+    """
+    def __init__(self, title: str, recipients: List[str], send_one, admin_chat_id):
+        self.id = uuid.uuid4().hex[:8]
+        self.title = title
+        self.recipients = [str(uid) for uid in recipients]
+        self.send_one = send_one
+        self.admin_chat_id = admin_chat_id
+        self.sent = 0
+        self.failed = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, application):
+        admin_campaigns[self.id] = self
+        self.task = application.create_task(self.run(application.bot))
+
+    def _cancel_keyboard(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Cancel", callback_data=f"campaign_cancel:{self.id}")]])
+
+    def _status_text(self, state: str) -> str:
+        remaining = len(self.recipients) - self.sent - self.failed
+        return f"{self.title} - {state}\n\n✅ Sent: {self.sent}\n❌ Failed: {self.failed}\n⏳ Remaining: {remaining}"
+
+    async def _send(self, user_id: str) -> bool:
+        try:
+            ok = await self.send_one(user_id)
+        except RetryAfter:
+            raise  # the fan-out engine backs off and retries
+        except Exception as e:
+            logger.warning(f"Campaign {self.id}: failed for {user_id}: {e}")
+            failure_kind = classify_delivery_error(e)
+            if failure_kind: sm.record_delivery_failure(user_id, failure_kind)
+            ok = False
+        if ok: self.sent += 1
+        else: self.failed += 1
+        return ok
+
+    async def _report(self, bot, message):
+        last_text = None
+        while True:
+            await asyncio.sleep(CAMPAIGN_PROGRESS_INTERVAL)
+            text = self._status_text("running")
+            if text == last_text: continue
+            try:
+                await bot.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=text, parse_mode=ParseMode.HTML, reply_markup=self._cancel_keyboard())
+                last_text = text
+            except Exception as e:
+                logger.debug(f"Campaign {self.id}: progress edit failed: {e}")
+
+    async def run(self, bot):
+        message = await bot.send_message(chat_id=self.admin_chat_id, text=self._status_text("running"), parse_mode=ParseMode.HTML, reply_markup=self._cancel_keyboard())
+        logger.info(f"📣 Campaign {self.id} started for {len(self.recipients)} users")
+        reporter = asyncio.create_task(self._report(bot, message))
+        state = "complete"
+        try:
+            results = await fanout.run(self.recipients, self._send, low_priority=True)
+            # Sends that gave up under flood control never reached _send's counters
+            self.failed += sum(1 for r in results if isinstance(r, BaseException))
+        except asyncio.CancelledError:
+            state = "cancelled"
+        finally:
+            reporter.cancel()
+            admin_campaigns.pop(self.id, None)
+        await sm.flush_dirty_state()
+        logger.info(f"📣 Campaign {self.id} {state}: {self.sent} sent, {self.failed} failed")
+        try:
+            await bot.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=self._status_text(state), parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.warning(f"Campaign {self.id}: final status edit failed: {e}")
+
+
+admin_campaigns: Dict[str, AdminCampaign] = {}
+
+
+async def campaign_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel a running admin campaign from its progress message"""
+    query = update.callback_query
+    if not is_admin(str(update.effective_user.id)):
+        await query.answer("⛔ You are not authorized.")
+        return
+    campaign = admin_campaigns.get(query.data.split(":", 1)[1])
+    if not campaign:
+        await query.answer("Campaign already finished.")
+        return
+    campaign.task.cancel()
+    await query.answer("🛑 Cancelling...")
+
 # --- BROADCAST FEATURE ---
 
 BROADCAST_TARGET, BROADCAST_MESSAGE, BROADCAST_PIN, BROADCAST_CONFIRM = range(4)
@@ -3667,62 +4273,48 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif target == "potential":
         recipients = sm.get_potential_users_list()
     
+    bot = context.bot
+
+    async def send_one(user_id: str) -> bool:
+        if content["type"] == "photo":
+            sent_msg = await bot.send_photo(
+                chat_id=user_id,
+                photo=content["file_id"],
+                caption=content["text"],
+                parse_mode=ParseMode.HTML
+            )
+        else:
+            sent_msg = await bot.send_message(
+                chat_id=user_id,
+                text=content["text"],
+                parse_mode=ParseMode.HTML
+            )
+        
+        # Pinning Logic
+        if sent_msg and pin_mode in ["notify", "silent"]:
+            try:
+                await bot.pin_chat_message(
+                    chat_id=user_id,
+                    message_id=sent_msg.message_id,
+                    disable_notification=(pin_mode == "silent")
+                )
+            except Exception as pin_error:
+                 # Often fails if bot not admin or private chat restrictions, just log it
+                 logger.debug(f"Failed to pin for {user_id}: {pin_error}")
+        return True
+
+    campaign = AdminCampaign("📢 <b>Broadcast</b>", recipients, send_one, update.effective_chat.id)
+    campaign.start(context.application)
+    
     # Check if we are editing a text message or a caption (if photo)
+    queued_text = f"🚀 Broadcast to {len(recipients)} users queued in the background (progress below)."
     try:
         if update.callback_query.message.photo:
-            await query.edit_message_caption(caption=f"🚀 Sending broadcast to {len(recipients)} users...")
+            await query.edit_message_caption(caption=queued_text)
         else:
-            await query.edit_message_text(f"🚀 Sending broadcast to {len(recipients)} users...")
+            await query.edit_message_text(queued_text)
     except Exception as e:
         logger.warning(f"Could not edit broadcast status message: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"🚀 Sending broadcast to {len(recipients)} users..."
-        )
-    
-    success_count = 0
-    fail_count = 0
-    
-    for user_id in recipients:
-        try:
-            sent_msg = None
-            if content["type"] == "photo":
-                sent_msg = await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=content["file_id"],
-                    caption=content["text"],
-                    parse_mode=ParseMode.HTML
-                )
-            else:
-                sent_msg = await context.bot.send_message(
-                    chat_id=user_id,
-                    text=content["text"],
-                    parse_mode=ParseMode.HTML
-                )
-            
-            # Pinning Logic
-            if sent_msg and pin_mode in ["notify", "silent"]:
-                try:
-                    await context.bot.pin_chat_message(
-                        chat_id=user_id,
-                        message_id=sent_msg.message_id,
-                        disable_notification=(pin_mode == "silent")
-                    )
-                except Exception as pin_error:
-                     # Often fails if bot not admin or private chat restrictions, just log it
-                     logger.debug(f"Failed to pin for {user_id}: {pin_error}")
-
-            success_count += 1
-            await asyncio.sleep(0.05) # Rate limit protection
-        except Exception as e:
-            logger.warning(f"Failed to broadcast to {user_id}: {e}")
-            fail_count += 1
-            
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"✅ <b>Broadcast Complete</b>\n\nSuccessful: {success_count}\nFailed: {fail_count}",
-        parse_mode=ParseMode.HTML
-    )
     
     return ConversationHandler.END
 
@@ -3804,30 +4396,18 @@ async def unpin_execute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif target == "active":
         recipients = sm.get_active_users()
         
-    await query.edit_message_text(f"🗑️ Unpinning messages for {len(recipients)} users...")
     logger.info(f"🗑️ Starting unpin_all for {len(recipients)} users (Target: {target})")
-    
-    count = 0
-    fail_count = 0
-    for user_id in recipients:
-        try:
-            # unpin_all_chat_messages returns True on success
-            success = await context.bot.unpin_all_chat_messages(chat_id=user_id)
-            if success:
-                count += 1
-            else:
-                logger.warning(f"   ⚠️ Unpin returned False for {user_id}")
-                fail_count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            logger.warning(f"   ❌ Unpin failed for {user_id}: {e}")
-            fail_count += 1
-            
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"✅ <b>Unpin Complete</b>\n\nCleared pins for {count} users.\nFailed/No Pins: {fail_count}",
-        parse_mode=ParseMode.HTML
-    )
+    bot = context.bot
+
+    async def unpin_one(user_id: str) -> bool:
+        # unpin_all_chat_messages returns True on success
+        success = await bot.unpin_all_chat_messages(chat_id=user_id)
+        if not success: logger.warning(f"   ⚠️ Unpin returned False for {user_id}")
+        return bool(success)
+
+    campaign = AdminCampaign("🗑️ <b>Unpin All</b>", recipients, unpin_one, update.effective_chat.id)
+    campaign.start(context.application)
+    await query.edit_message_text(f"🗑️ Unpinning messages for {len(recipients)} users in the background (progress below).")
     return ConversationHandler.END
 
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3950,7 +4530,7 @@ def run_bot():
         logger.info(f"   Poll Interval: {POLL_INTERVAL} seconds")
         logger.info(f"   Max Runtime: {MAX_JOB_RUNTIME} seconds")
         
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
+        app = Application.builder().token(TELEGRAM_TOKEN).post_shutdown(flush_checkpoints).build()
         
         # Command Handlers
         # Broadcast Handler
@@ -3993,6 +4573,7 @@ def run_bot():
         app.add_handler(CommandHandler("subscribe", subscribe))
         app.add_handler(CommandHandler("billing", billing_portal))
         app.add_handler(CommandHandler("help", show_help))  # Help command
+        app.add_handler(CallbackQueryHandler(campaign_cancel, pattern="^campaign_cancel:"))
         app.add_handler(CallbackQueryHandler(button_handler))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         
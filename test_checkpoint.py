@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Tests for the bot cursor's write-behind CheckpointManager"""
+
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from checkpoint_utils import CheckpointManager
+
+
+def make_manager(tmp_path, upload_results):
+    state = {"n": 0}
+    uploads = []
+
+    def upload(path):
+        uploads.append(json.load(open(path)))
+        return upload_results.pop(0) if upload_results else True
+
+    manager = CheckpointManager(str(tmp_path / "cursor.json"), lambda: dict(state), upload, interval=0)
+    return manager, state, uploads
+
+
+def test_coalesces_saves_into_one_write(tmp_path):
+    manager, state, uploads = make_manager(tmp_path, [])
+    for i in range(10):
+        state["n"] = i
+        manager.mark_dirty()
+    assert asyncio.run(manager.flush()) is True
+    assert uploads == [{"n": 9}]
+    assert json.load(open(manager.local_path)) == {"n": 9}
+    assert not os.path.exists(manager.local_path + ".tmp")
+    assert asyncio.run(manager.flush()) is None  # nothing dirty, nothing uploaded
+    assert len(uploads) == 1
+
+
+def test_failed_upload_is_retried_on_next_flush(tmp_path):
+    manager, state, uploads = make_manager(tmp_path, [False, True])
+    state["n"] = 1
+    manager.mark_dirty()
+    assert asyncio.run(manager.flush()) is False
+    assert manager.dirty and manager.written_seq == 0
+
+    assert asyncio.run(manager.flush()) is True
+    assert not manager.dirty and manager.written_seq == manager.seq
+    assert uploads == [{"n": 1}, {"n": 1}]
+
+
+def test_flush_respects_interval_unless_forced(tmp_path):
+    manager, state, uploads = make_manager(tmp_path, [])
+    manager.interval = 3600
+    manager.mark_dirty()
+    assert asyncio.run(manager.flush()) is True
+    manager.mark_dirty()
+    assert asyncio.run(manager.flush()) is None
+    assert asyncio.run(manager.flush(force=True)) is True
+    assert manager.flush_now() is None
+    assert len(uploads) == 2
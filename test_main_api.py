@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Tests for the API's feed cursors, keyset filters and push routing index"""
+
+import os
+import sys
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.dirname(__file__))
+# main_api reads its Supabase config at import time; nothing here talks to it
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "test")
+
+from main_api import PushRoutingIndex, decode_feed_cursor, encode_feed_cursor, keyset_filter, keyset_newer_filter
+
+
+def test_feed_cursor_round_trip():
+    cursor = encode_feed_cursor("2026-01-02T03:04:05.123456+00:00", 42)
+    assert "=" not in cursor
+    assert decode_feed_cursor(cursor) == ("2026-01-02T03:04:05.123456+00:00", 42)
+
+
+def test_bad_feed_cursor_decodes_to_none():
+    assert decode_feed_cursor(None) is None
+    assert decode_feed_cursor("") is None
+    assert decode_feed_cursor("not-a-cursor") is None
+    assert decode_feed_cursor(encode_feed_cursor("2026-01-02T00:00:00", "abc")) is None
+
+
+def test_keyset_filters_break_timestamp_ties_on_id():
+    after = ("2026-01-02T03:04:05+00:00", 7)
+    assert unquote(keyset_filter(after)) == \
+        'or(scraped_at.lt."2026-01-02T03:04:05+00:00",and(scraped_at.eq."2026-01-02T03:04:05+00:00",id.lt.7))'
+    assert unquote(keyset_newer_filter(after)) == \
+        'scraped_at.gt."2026-01-02T03:04:05+00:00",and(scraped_at.eq."2026-01-02T03:04:05+00:00",id.gt.7)'
+    # '+' must stay encoded or PostgREST reads it as a space
+    assert "+" not in keyset_filter(after) and "+" not in keyset_newer_filter(after)
+
+
+def test_routing_matches_region_category_and_wildcard():
+    index = PushRoutingIndex()
+    index.rebuild([
+        {"id": 1, "push_tokens": ["t1"], "notification_preferences": {"regions": {"UK Stores": ["ALL"]}}},
+        {"id": 2, "push_tokens": ["t2"], "notification_preferences": {"regions": {"UK Stores": ["flips"]}}},
+        {"id": 3, "push_tokens": "t3", "notification_preferences": None},
+        {"id": 4, "push_tokens": ["t4"], "notification_preferences": {"enabled": False}},
+        {"id": 5, "push_tokens": [], "notification_preferences": None},
+    ])
+    assert index.ready and set(index.users) == {"1", "2", "3"}
+    assert sorted(index.targets("UK Stores", "flips")) == ["t1", "t2", "t3"]
+    assert sorted(index.targets("UK Stores", "argos")) == ["t1", "t3"]
+    assert sorted(index.targets("USA Stores", "flips")) == ["t3"]
+
+
+def test_routing_updates_and_removals_leave_no_stale_routes():
+    index = PushRoutingIndex()
+    index.set_user("1", ["t1"], {"regions": {"UK Stores": ["flips"]}})
+    index.set_user("1", ["t1"], {"regions": {"USA Stores": ["ALL"]}})
+    assert index.targets("UK Stores", "flips") == []
+    assert index.targets("USA Stores", "any") == ["t1"]
+
+    index.set_user("1", None, {"regions": {"USA Stores": ["ALL"]}})  # tokens cleared
+    assert index.users == {} and index.routes == {}
+
+
+def test_drop_tokens_keeps_live_tokens_and_returns_owners():
+    index = PushRoutingIndex()
+    index.set_user("1", ["dead", "live"])
+    index.set_user("2", ["dead2"])
+    assert index.drop_tokens({"dead", "dead2"}) == {"1", "2"}
+    assert index.targets("UK Stores", "flips") == ["live"]
+    assert "2" not in index.users and index.routes == {PushRoutingIndex.WILDCARD: {"1"}}
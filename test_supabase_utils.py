@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Tests for product dedup before materializing into the products table"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import supabase_utils
+from supabase_utils import dedup_product_rows, _parse_ts
+
+
+def row(row_id, scraped_at, signature="sig"):
+    return {"id": row_id, "scraped_at": scraped_at, "signature": signature}
+
+
+def stored(monkeypatch, found):
+    """Stub the products-table lookup with already stored (id, scraped_at) per signature"""
+    calls = []
+
+    def fake(url, key, signatures, since):
+        calls.append((signatures, since))
+        return {sig: [(i, _parse_ts(ts)) for i, ts in entries] for sig, entries in found.items()}
+
+    monkeypatch.setattr(supabase_utils, "_recent_signatures", fake)
+    return calls
+
+
+def test_drops_repeats_within_window_in_the_same_batch(monkeypatch):
+    calls = stored(monkeypatch, {})
+    rows = [row(2, "2026-01-01T10:05:00"), row(1, "2026-01-01T10:00:00"), row(3, "2026-01-01T10:20:00")]
+    kept = dedup_product_rows(rows, "url", "key", debug=False)
+    # 10:05 repeats 10:00 within the window; 10:20 is past it
+    assert [r["id"] for r in kept] == [1, 3]
+    assert calls[0][0] == ["sig"]
+    assert calls[0][1] == _parse_ts("2026-01-01T10:00:00") - supabase_utils.PRODUCT_DEDUP_WINDOW
+
+
+def test_drops_rows_already_stored_under_another_id(monkeypatch):
+    stored(monkeypatch, {"sig": [(9, "2026-01-01T09:58:00")]})
+    kept = dedup_product_rows([row(1, "2026-01-01T10:00:00Z"), row(2, "2026-01-01T10:00:00", "other")], "url", "key", debug=False)
+    assert [r["id"] for r in kept] == [2]
+
+
+def test_reprocessing_the_same_id_is_kept(monkeypatch):
+    stored(monkeypatch, {"sig": [(1, "2026-01-01T10:00:00")]})
+    kept = dedup_product_rows([row(1, "2026-01-01T10:00:00")], "url", "key", debug=False)
+    assert [r["id"] for r in kept] == [1]
+
+
+def test_lookup_failure_falls_back_to_batch_dedup(monkeypatch):
+    def broken(*args):
+        raise RuntimeError("down")
+
+    monkeypatch.setattr(supabase_utils, "_recent_signatures", broken)
+    kept = dedup_product_rows([row(1, "2026-01-01T10:00:00"), row(2, "2026-01-01T10:01:00")], "url", "key", debug=False)
+    assert [r["id"] for r in kept] == [1]